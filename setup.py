@@ -1,6 +1,6 @@
 from setuptools import setup
 
-torch = ['torch>=1.0.0']
+torch = ['torch>=1.11.0']
 all = torch
 
 extras_require = {
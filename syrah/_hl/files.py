@@ -16,33 +16,109 @@
     You should have received a copy of the GNU General Public License
     along with Syrah.  If not, see <https://www.gnu.org/licenses/>.
 """
-from typing import Union, Dict, Optional, Type
+from typing import Union, Dict, Optional, Type, List, Tuple, Iterator, Iterable, Any, Sequence, IO
 from types import TracebackType
+from operator import itemgetter
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import os
+import mmap
+import threading
+import shutil
+import tempfile
 
 from .metadata import MetadataReader, MetadataWriter
 from .serialization import *
 from .. import version
 from .. import config
+from ..utils import pool
+
+
+"""
+    Names of the (posix_fadvise, madvise) advice constants for each access hint
+"""
+_ACCESS_HINTS = {
+    'random': ('POSIX_FADV_RANDOM', 'MADV_RANDOM'),
+    'sequential': ('POSIX_FADV_SEQUENTIAL', 'MADV_SEQUENTIAL'),
+    None: ('POSIX_FADV_NORMAL', 'MADV_NORMAL')
+}
+
+"""
+    Maximum number of buffers in a single gather write
+"""
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16
+
+"""
+    Flag of positional reads that only return data already in the page cache (Linux), None if not supported
+"""
+_RWF_NOWAIT: Optional[int] = getattr(os, 'RWF_NOWAIT', None) if hasattr(os, 'preadv') else None
+
+"""
+    Deserialized metadata of the last opened files, keyed by (path, modification time, size, offset, length)
+"""
+_METADATA_CACHE: 'OrderedDict[tuple, MetadataReader]' = OrderedDict()
+_METADATA_CACHE_LOCK = threading.Lock()
+
+
+def check_access_hint(access_hint: Optional[str]):
+    """
+    Raise an exception if the access hint is not supported.
+    :param access_hint: expected read access pattern
+    :return:
+    """
+    if access_hint not in _ACCESS_HINTS:
+        hints = ', '.join(hint for hint in _ACCESS_HINTS if hint is not None)
+        raise ValueError(f'Expected access hint to be one of {hints} or None, got {access_hint}.')
 
 
 class File:
     """
         Represents a Syrah dataset file.
     """
-    def __init__(self, file_path: str, mode: str):
+    def __init__(self, file_path: str, mode: str, io_threads: int = 0, use_mmap: bool = False,
+                 columnar: bool = False, access_hint: Optional[str] = None, prefetch: bool = False):
         """
         Create a new file object.
         :param file_path: path to the file on disk
         :param mode: opening mode (currently, only "r" or "w" supported)
+        :param io_threads: number of threads used to issue non-contiguous reads concurrently (0 to read sequentially)
+        :param use_mmap: memory-map the file in read mode and return arrays as read-only views of the mapping
+        :param columnar: in write mode, store all the arrays of a given name contiguously instead of item by item
+        :param access_hint: expected read access pattern passed to the kernel ("random", "sequential" or None)
+        :param prefetch: read the next item in a background thread after each `get_item` call
         """
+        check_access_hint(access_hint)
+
         self._file_path = file_path
         self._mode = mode
         self._fp = None
+        self._fp_lock = threading.Lock()
+        self._fp_position: Optional[int] = None
+        self._access_hint = access_hint
+        self._use_mmap = use_mmap
+        self._mm: Optional[mmap.mmap] = None
+        self._io_threads = io_threads
+        self._io_executor: Optional[ThreadPoolExecutor] = None
+        self._nowait_reads = _RWF_NOWAIT is not None
+        self._prefetch = prefetch
+        self._prefetch_executor: Optional[ThreadPoolExecutor] = None
+        self._prefetch_index: Optional[int] = None
+        self._prefetch_array_names: Optional[Sequence[str]] = None
+        self._prefetch_future: Optional[Future] = None
         self._version = None
         self._metadata_offset = None
         self._metadata_length = None
         self._metadata: Optional[Union[MetadataReader, MetadataWriter]] = None
         self._item_offset = None
+        self._item_type: Optional[Type[tuple]] = None
+        self._item_fields: Optional[Dict[str, int]] = None
+        self._columnar = columnar
+        self._column_files: Dict[str, IO] = dict()
+        self._column_sizes: Dict[str, int] = dict()
 
         self.open(file_path, mode)
         self._init_data()
@@ -61,7 +137,43 @@ class File:
         if self._fp is not None:
             self.close()
 
-        self._fp = open(self._file_path, self._mode + 'b')
+        self._fp_position = None
+
+        if self._mode == 'w':
+            self._fp = open(self._file_path, 'wb', buffering=config.WRITE_BUFFER_SIZE)
+        else:
+            self._fp = open(self._file_path, self._mode + 'b')
+
+        if self._mode == 'r' and self._use_mmap:
+            self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mode == 'r' and self._access_hint is not None:
+            self._advise()
+
+    def set_access_hint(self, access_hint: Optional[str]):
+        """
+        Change the expected read access pattern, e.g. when switching between shuffled epochs and full scans.
+        :param access_hint: expected read access pattern passed to the kernel ("random", "sequential" or None)
+        :return:
+        """
+        check_access_hint(access_hint)
+        self._access_hint = access_hint
+
+        if self._fp is not None and not self._fp.closed and self._mode == 'r':
+            self._advise()
+
+    def _advise(self):
+        """
+        Advise the kernel of the expected access pattern to tune readahead.
+        Hints are ignored on platforms that do not support them.
+        :return:
+        """
+        fadvise_hint, madvise_hint = _ACCESS_HINTS[self._access_hint]
+
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self._fp.fileno(), 0, 0, getattr(os, fadvise_hint))
+        if self._mm is not None and hasattr(mmap, madvise_hint):
+            self._mm.madvise(getattr(mmap, madvise_hint))
 
     def _init_data(self):
         """
@@ -79,14 +191,62 @@ class File:
         self._version = version.version
 
         self._metadata = MetadataWriter()
-        self._item_offset = config.NUM_BYTES_VERSION + config.NUM_BYTES_METADATA_LENGTH + \
-            config.NUM_BYTES_METADATA_LENGTH + config.NUM_BYTES_MAGIC_BYTES
+        self._item_offset = config.NUM_BYTES_HEADERS
+
+        # items are appended sequentially from here, headers are written on flush
+        self._fp.seek(self._item_offset)
 
     def _init_data_read(self):
         self._read_headers()
 
-        self._fp.seek(self._metadata_offset)
-        self._metadata = MetadataReader(self._fp.read(self._metadata_length))
+        self._metadata = self._load_metadata()
+        self._item_type = None
+        self._item_fields = None
+
+    def _load_metadata(self) -> MetadataReader:
+        """
+        Deserialize the metadata of the file or get it from the cache if the file was already opened.
+        :return: metadata reader
+        """
+        stat = os.fstat(self._fp.fileno())
+        key = (os.path.realpath(self._file_path), stat.st_mtime_ns, stat.st_size, self._metadata_offset,
+               self._metadata_length)
+
+        with _METADATA_CACHE_LOCK:
+            metadata = _METADATA_CACHE.get(key)
+            if metadata is not None:
+                _METADATA_CACHE.move_to_end(key)
+                return metadata
+
+        if self._metadata_offset < config.NUM_BYTES_HEADERS or \
+                self._metadata_offset + self._metadata_length > stat.st_size:
+            raise IOError(f'Metadata range [{self._metadata_offset}, {self._metadata_offset + self._metadata_length}) '
+                          f'out of file bounds, the file may be truncated or not properly closed.')
+
+        metadata_serialized = self._read(self._metadata_offset, self._metadata_length)
+
+        if self._mm is not None:
+            # the (lazily deserialized, possibly cached) metadata must not hold a view of the mapping
+            metadata_serialized = bytes(metadata_serialized)
+
+        metadata = MetadataReader(metadata_serialized)
+
+        if config.METADATA_CACHE_SIZE > 0:
+            with _METADATA_CACHE_LOCK:
+                _METADATA_CACHE[key] = metadata
+                while len(_METADATA_CACHE) > config.METADATA_CACHE_SIZE:
+                    _METADATA_CACHE.popitem(last=False)
+
+        return metadata
+
+    @staticmethod
+    def clear_metadata_cache():
+        """
+        Remove all the deserialized metadata kept for previously opened files.
+        :return:
+        """
+        with _METADATA_CACHE_LOCK:
+            _METADATA_CACHE.clear()
 
     def __enter__(self):
         """
@@ -112,6 +272,24 @@ class File:
         Needs to be called explicitly or use a "with" statement.
         :return:
         """
+        if self._io_executor is not None:
+            self._io_executor.shutdown()
+            self._io_executor = None
+
+        if self._prefetch_executor is not None:
+            self._prefetch_executor.shutdown()
+            self._prefetch_executor = None
+            self._prefetch_index = None
+            self._prefetch_future = None
+
+        if self._mm is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # arrays returned by the File still reference the mapping, it is unmapped once they are released
+                pass
+            self._mm = None
+
         if self._fp is None:
             return
         if self._fp.closed:
@@ -122,6 +300,10 @@ class File:
         self._fp.close()
 
     def validate_file_handle(self, mode):
+        # called on every read and write: check the expected state first and only build the error otherwise
+        if self._mode == mode and self._fp is not None and not self._fp.closed:
+            return
+
         if mode == 'r':
             message = 'Trying to read an item from'
         elif mode == 'w':
@@ -136,48 +318,451 @@ class File:
         if self._mode != mode:
             raise IOError(f'File is expected to be opened in "{mode}" mode, got "{self._mode}".')
 
-    def get_item(self, index: int) -> Dict[str, ndarray]:
+    def get_item(self, index: int, as_tuple: bool = False,
+                 array_names: Optional[Sequence[str]] = None) -> Union[Dict[str, ndarray], tuple]:
         """
         Get an item from the dataset.
+        The arrays of the item are read together, contiguous arrays being merged into a single read.
         :param index: index of the item in the dataset
-        :return: a dictionary of (array name, array data) pairs
+        :param as_tuple: return the item as a named tuple with one field per array instead of a dictionary
+        :param array_names: names of the arrays to retrieve (all of them if None), not supported with `as_tuple`
+        :return: a dictionary of (array name, array data) pairs, or a named tuple if `as_tuple` is True
         """
         self.validate_file_handle('r')
 
         if index >= len(self._metadata):
             raise IndexError(f'Item {index} out of range.')
 
-        data: Dict[str, ndarray] = dict()
+        if array_names is not None:
+            if as_tuple:
+                raise ValueError('Items returned as named tuples contain all the arrays, array_names cannot be '
+                                 'specified.')
+            # compared with the names of the prefetched item
+            array_names = tuple(array_names)
+
+        if self._prefetch_future is not None and self._prefetch_index == index and \
+                self._prefetch_array_names == array_names:
+            item_serialized = self._prefetch_future.result()
+        else:
+            item_serialized = self._read_item(index, array_names)
+
+        self._prefetch_future = None
+
+        if self._prefetch and index + 1 < len(self._metadata):
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(max_workers=1)
+            self._prefetch_index = index + 1
+            self._prefetch_array_names = array_names
+            self._prefetch_future = self._prefetch_executor.submit(self._read_item, index + 1, array_names)
 
-        for key, array_metadata in self._metadata.metadata.items():
-            self._fp.seek(self._metadata.get(index, key, 'offset'))
-            array_serialized: AnyStr = self._fp.read(self._metadata.get(index, key, 'size'))
+        if as_tuple:
+            if self._item_type is None:
+                # invalid identifiers are renamed to positional names (e.g. "_0")
+                self._item_type = namedtuple('Item', self._metadata.metadata.keys(), rename=True)
+                self._item_fields = {key: position for position, key in enumerate(self._metadata.metadata.keys())}
 
-            data[key]: ndarray = deserialize_array(array_serialized, self._metadata.get(index, key, 'dtype'))
+            values = [None] * len(self._item_fields)
+
+            for (key, dtype), array_serialized in item_serialized:
+                values[self._item_fields[key]] = deserialize_array(array_serialized, dtype)
+
+            return self._item_type._make(values)
+
+        data: Dict[str, ndarray] = dict()
+
+        for (key, dtype), array_serialized in item_serialized:
+            data[key]: ndarray = deserialize_array(array_serialized, dtype)
 
         return data
 
-    def get_array(self, index: int, array_name: str, dtype: Optional[str] = None) -> ndarray:
+    def _read_item(self, index: int,
+                   array_names: Optional[Sequence[str]] = None) -> List[Tuple[Tuple[str, str], memoryview]]:
+        """
+        Read the serialized arrays of an item.
+        :param index: index of the item in the dataset
+        :param array_names: names of the arrays to read (all of them if None)
+        :return: list of ((array name, array type), serialized array) pairs
+        """
+        if array_names is None:
+            chunks = [(offset, size, (key, dtype)) for key, offset, size, dtype in self._metadata.iter_item(index)]
+        else:
+            chunks = []
+            for key in array_names:
+                offset, size, dtype = self._metadata.locate(index, key)
+                chunks.append((offset, size, (key, dtype)))
+
+        # the arrays of an item are usually contiguous: read their whole span at once without planning runs,
+        # as long as it does not contain more unrequested bytes than the runs could have
+        run_offset = min([offset for offset, _, _ in chunks], default=0)
+        run_size = max([offset + size for offset, size, _ in chunks], default=0) - run_offset
+
+        if run_size - sum([size for _, size, _ in chunks]) > config.READ_MERGE_GAP * (len(chunks) - 1):
+            return list(self._read_chunks(chunks))
+
+        # arrays sliced from a single buffer are misaligned if their position in it is not a multiple of the alignment
+        # of their type (e.g. float64 after an odd-sized int8 array), in which case each one is read into its own buffer
+        if self._mm is None and hasattr(os, 'preadv') and len(chunks) < _IOV_MAX // 2 and \
+                any([(offset - run_offset) % dtype_alignments.get(dtype, 1) for offset, _, (_, dtype) in chunks]):
+            item_serialized = self._scatter_read(chunks)
+            if item_serialized is not None:
+                return item_serialized
+
+        run_buffer = self._read(run_offset, run_size)
+
+        return [(tag, run_buffer[offset - run_offset:offset - run_offset + size]) for offset, size, tag in chunks]
+
+    def _scatter_read(self, chunks: List[Tuple[int, int, Any]]) -> Optional[List[Tuple[Any, memoryview]]]:
+        """
+        Read byte ranges with a single system call, each range into its own new buffer
+        (so that the arrays deserialized from it are aligned and do not keep the other ranges in memory).
+        The bytes between the ranges are read into a discarded buffer.
+        :param chunks: list of (offset, size, tag) tuples
+        :return: list of (tag, buffer) pairs in the order of the chunks, None if ranges overlap
+        """
+        if not chunks:
+            return []
+
+        buffers = [np.empty(size, dtype=np.uint8) for _, size, _ in chunks]
+        scatter = []
+        run_offset = position = min([offset for offset, _, _ in chunks])
+
+        for chunk_index in sorted(range(len(chunks)), key=lambda chunk_index: chunks[chunk_index][0]):
+            offset, size, _ = chunks[chunk_index]
+            if offset < position:
+                return None
+            if offset > position:
+                scatter.append(np.empty(offset - position, dtype=np.uint8))
+
+            scatter.append(buffers[chunk_index])
+            position = offset + size
+
+        num_bytes = os.preadv(self._fp.fileno(), scatter, run_offset)
+
+        if num_bytes != position - run_offset:
+            raise IOError(f'Expected to read {position - run_offset} bytes at offset {run_offset}, got {num_bytes}.')
+
+        return [(tag, memoryview(buffer)) for (_, _, tag), buffer in zip(chunks, buffers)]
+
+    def get_items(self, indices: Sequence[int],
+                  array_names: Optional[Sequence[str]] = None) -> List[Dict[str, ndarray]]:
+        """
+        Get several items from the dataset at once.
+        The arrays of all the items are read together, contiguous arrays being merged into a single read.
+        :param indices: indices of the items in the dataset
+        :param array_names: names of the arrays to retrieve (all of them if None)
+        :return: list of dictionaries of (array name, array data) pairs, in the order of the indices
+        """
+        self.validate_file_handle('r')
+
+        indices = np.asarray(indices, dtype=np.int64)
+
+        if len(indices) > 0 and indices.max() >= len(self._metadata):
+            raise IndexError(f'Item {indices.max()} out of range.')
+
+        chunks = [(offset, size, (position, key, dtype))
+                  for position, item_arrays in enumerate(self._metadata.iter_items(indices, array_names))
+                  for key, offset, size, dtype in item_arrays]
+
+        items: List[Dict[str, ndarray]] = [dict() for _ in indices]
+
+        for (position, key, dtype), array_serialized in self._read_chunks(chunks):
+            items[position][key] = deserialize_array(array_serialized, dtype)
+
+        return items
+
+    def get_stack(self, indices: Sequence[int], array_name: str) -> ndarray:
+        """
+        Get the arrays with the given name for several items, stacked into a single array.
+        All the arrays with this name need to have the same size.
+        If the arrays are stored contiguously in the order of the indices, they are fetched with a single read
+        (or returned as a read-only view of the mapping if the file is memory-mapped).
+        :param indices: indices of the items in the dataset
+        :param array_name: name of the arrays to retrieve
+        :return: 2-D array with one (flattened) array per index
+        """
+        self.validate_file_handle('r')
+
+        if array_name not in self._metadata.metadata:
+            raise KeyError(f'Key {array_name} could not be found in metadata.')
+
+        indices = np.asarray(indices, dtype=np.int64)
+
+        if len(indices) > 0 and indices.max() >= len(self._metadata):
+            raise IndexError(f'Item {indices.max()} out of range.')
+
+        size = self._metadata.get_fixed_size(array_name)
+
+        if size is None:
+            raise ValueError(f'Arrays {array_name} do not all have the same size and cannot be stacked.')
+
+        offsets = self._metadata.columns[array_name]['offset'][indices]
+        dtype = self._metadata.get(0, array_name, 'dtype')
+        contiguous = len(indices) > 0 and np.all(np.diff(offsets) == size)
+
+        if contiguous and self._mm is not None:
+            # the type is validated as when reading into a new array
+            itemsize = empty_array(0, dtype).itemsize
+            stack = np.frombuffer(self._mm, dtype=dtype, count=size * len(indices) // itemsize, offset=offsets[0])
+            return stack.reshape(len(indices), -1)
+
+        stack = empty_array(size * len(indices), dtype)
+        stack = stack.reshape(len(indices), size // stack.itemsize)
+        stack_bytes = stack.reshape(-1).view(np.uint8)
+
+        if contiguous:
+            runs = [(offsets[0], stack_bytes)]
+        else:
+            runs = zip(offsets, stack_bytes.reshape(len(indices), size))
+
+        for offset, buffer in runs:
+            num_bytes = self._readinto(offset, buffer)
+
+            if num_bytes != len(buffer):
+                raise IOError(f'Expected to read {len(buffer)} bytes at offset {offset}, got {num_bytes}.')
+
+        return stack
+
+    def get_batch(self, indices: Sequence[int], array_names: Optional[Sequence[str]] = None) -> Dict[str, ndarray]:
+        """
+        Get several items from the dataset as one stacked array per name instead of one dictionary per item.
+        All the arrays with a requested name need to have the same size.
+        The arrays of all the names are read together, nearby arrays being merged into a single read,
+        and copied into the stacks.
+        :param indices: indices of the items in the dataset
+        :param array_names: names of the arrays to retrieve (all of them if None)
+        :return: dictionary of (array name, 2-D array with one flattened array per index) pairs
+        """
+        self.validate_file_handle('r')
+
+        if array_names is None:
+            array_names = list(self._metadata.metadata.keys())
+
+        indices = np.asarray(indices, dtype=np.int64)
+
+        if len(indices) > 0 and indices.max() >= len(self._metadata):
+            raise IndexError(f'Item {indices.max()} out of range.')
+
+        stacks: Dict[str, ndarray] = dict()
+        chunks = []
+
+        for array_name in array_names:
+            if array_name not in self._metadata.metadata:
+                raise KeyError(f'Key {array_name} could not be found in metadata.')
+
+            size = self._metadata.get_fixed_size(array_name)
+
+            if size is None:
+                raise ValueError(f'Arrays {array_name} do not all have the same size and cannot be stacked.')
+
+            stack = empty_array(size * len(indices), self._metadata.get(0, array_name, 'dtype'))
+            stack = stack.reshape(len(indices), size // stack.itemsize)
+            stacks[array_name] = stack
+
+            offsets = self._metadata.columns[array_name]['offset'][indices]
+            chunks.extend(zip(offsets.tolist(), [size] * len(indices), stack.view(np.uint8)))
+
+        for row, array_serialized in self._read_chunks(chunks):
+            row[:] = array_serialized
+
+        return stacks
+
+    def get_array(self, index: int, array_name: str, dtype: Optional[str] = None,
+                  out: Optional[ndarray] = None) -> ndarray:
         """
         Get an array from the dataset.
         :param index: index of the item in the dataset
         :param array_name: name of the array to retrieve
         :param dtype: type of the array to decode (if specified, overrides the value contained in the metadata)
-        :return: an array
+        :param out: existing array to read the data into instead of a new one (e.g. a row of a preallocated batch),
+            needs to be writable, C-contiguous and of the same type and size in bytes as the array
+        :return: an array (`out` if specified)
         """
         self.validate_file_handle('r')
 
         if index >= len(self._metadata):
             raise IndexError(f'Item {index} out of range.')
 
-        if array_name not in self._metadata.metadata:
-            raise KeyError(f'Key {array_name} could not be found in metadata.')
+        offset, size, array_dtype = self._metadata.locate(index, array_name)
+        dtype = dtype or array_dtype
+
+        if out is not None:
+            if dtype == 'str' or dtype_to_string(out.dtype) != dtype:
+                raise TypeError(f'Expected out to be an array of type {dtype}, got {out.dtype}.')
+            if out.nbytes != size or not out.flags.c_contiguous or not out.flags.writeable:
+                raise ValueError(f'Expected out to be a writable C-contiguous array of {size} bytes.')
+
+            num_bytes = self._readinto(offset, out.reshape(-1).view(np.uint8))
+
+            if num_bytes != size:
+                raise IOError(f'Expected to read {size} bytes at offset {offset}, got {num_bytes}.')
+
+            return out
+
+        if dtype == 'str' and self._mm is None:
+            # strings are decoded into a new object, the serialized bytes can be read into a reused buffer
+            buffer = pool.get_buffer(size)
+            try:
+                with memoryview(buffer)[:size] as array_serialized:
+                    num_bytes = self._readinto(offset, array_serialized)
+
+                    if num_bytes != size:
+                        raise IOError(f'Expected to read {size} bytes at offset {offset}, got {num_bytes}.')
+
+                    return deserialize_array(array_serialized, dtype)
+            finally:
+                pool.release_buffer(buffer)
+
+        return deserialize_array(self._read(offset, size), dtype)
+
+    def _read(self, offset: int, size: int) -> memoryview:
+        """
+        Read a byte range from the file without relying on the shared file cursor.
+        The bytes are read directly into a new writable buffer, so that arrays deserialized from it are writable
+        and no intermediate bytes object is allocated.
+        If the file is memory-mapped, returns a zero-copy (read-only) view of the mapping instead.
+        :param offset: position of the first byte to read
+        :param size: number of bytes to read
+        :return: view of the bytes read
+        """
+        if self._mm is not None:
+            if offset + size > len(self._mm):
+                num_bytes = max(len(self._mm) - offset, 0)
+                raise IOError(f'Expected to read {size} bytes at offset {offset}, got {num_bytes}.')
+            return memoryview(self._mm)[offset:offset + size]
+
+        buffer = np.empty(size, dtype=np.uint8)
+        num_bytes = self._readinto(offset, buffer)
+
+        if num_bytes != size:
+            raise IOError(f'Expected to read {size} bytes at offset {offset}, got {num_bytes}.')
+
+        return memoryview(buffer)
+
+    def _readinto(self, offset: int, buffer: memoryview) -> int:
+        """
+        Read a byte range from the file into an existing buffer without relying on the shared file cursor.
+        Falls back to seek and readinto on platforms without `os.preadv`.
+        :param offset: position of the first byte to read
+        :param buffer: writable buffer, filled up to its length
+        :return: number of bytes read
+        """
+        if self._mm is not None:
+            buffer = memoryview(buffer).cast('B')
+            source = memoryview(self._mm)[offset:offset + len(buffer)]
+            buffer[:len(source)] = source
+            return len(source)
+
+        if hasattr(os, 'preadv'):
+            return os.preadv(self._fp.fileno(), [buffer], offset)
+
+        with self._fp_lock:
+            self._seek(offset)
+            num_bytes = self._fp.readinto(buffer)
+            self._fp_position = offset + num_bytes
+
+        return num_bytes
+
+    def _seek(self, offset: int):
+        """
+        Move the file cursor for the seek and read fallback, skipping the call if it is already in place
+        (e.g. when reading the arrays of consecutive items).
+        :param offset: new position of the cursor
+        :return:
+        """
+        if self._fp_position != offset:
+            self._fp.seek(offset)
+            self._fp_position = offset
+
+    @staticmethod
+    def _plan_runs(chunks: List[Tuple[int, int, Any]]) -> List[Tuple[int, int, List[Tuple[int, int, Any]]]]:
+        """
+        Group byte ranges into runs of contiguous ranges.
+        Overlapping ranges and ranges separated by at most `config.READ_MERGE_GAP` bytes are merged as well,
+        the bytes in the gaps being read and discarded.
+        :param chunks: list of (offset, size, tag) tuples
+        :return: list of (run offset, run size, chunks of the run) tuples sorted by offset
+        """
+        chunks = sorted(chunks, key=itemgetter(0))
+        runs = []
+        start = 0
+
+        while start < len(chunks):
+            run_offset, run_size, _ = chunks[start]
+            run_end = run_offset + run_size
+            end = start + 1
 
-        self._fp.seek(self._metadata.get(index, array_name, 'offset'))
-        array_serialized = self._fp.read(self._metadata.get(index, array_name, 'size'))
-        dtype = dtype or self._metadata.get(index, array_name, 'dtype')
+            while end < len(chunks) and chunks[end][0] <= run_end + config.READ_MERGE_GAP:
+                run_end = max(run_end, chunks[end][0] + chunks[end][1])
+                end += 1
 
-        return deserialize_array(array_serialized, dtype)
+            runs.append((run_offset, run_end - run_offset, chunks[start:end]))
+            start = end
+
+        return runs
+
+    def _read_chunks(self, chunks: List[Tuple[int, int, Any]]) -> Iterator[Tuple[Any, memoryview]]:
+        """
+        Read several byte ranges, merging contiguous (or nearly contiguous) ranges into a single read.
+        If the File was created with `io_threads > 0`, non-contiguous runs are read concurrently.
+        :param chunks: list of (offset, size, tag) tuples
+        :return: iterator over (tag, buffer) pairs in file order, buffers are views over the merged reads
+        """
+        runs = self._plan_runs(chunks)
+
+        if self._io_threads > 0 and len(runs) > 1:
+            if self._io_executor is None:
+                self._io_executor = ThreadPoolExecutor(max_workers=self._io_threads)
+            run_buffers = [self._submit_read(run_offset, run_size) for run_offset, run_size, _ in runs]
+            run_buffers = (run_buffer.result() if isinstance(run_buffer, Future) else run_buffer
+                           for run_buffer in run_buffers)
+        else:
+            run_buffers = (self._read(run_offset, run_size) for run_offset, run_size, _ in runs)
+
+        for (run_offset, _, run_chunks), run_buffer in zip(runs, run_buffers):
+            for offset, size, tag in run_chunks:
+                yield tag, run_buffer[offset - run_offset:offset - run_offset + size]
+
+    def _submit_read(self, offset: int, size: int) -> Union[memoryview, Future]:
+        """
+        Read a byte range in the calling thread if it is already in the page cache,
+        otherwise hand over the (remaining) read to the I/O threads.
+        :param offset: position of the first byte to read
+        :param size: number of bytes to read
+        :return: view of the bytes read, or future of it
+        """
+        if self._mm is not None or not self._nowait_reads:
+            return self._io_executor.submit(self._read, offset, size)
+
+        buffer = np.empty(size, dtype=np.uint8)
+
+        try:
+            num_bytes = os.preadv(self._fp.fileno(), [buffer], offset, _RWF_NOWAIT)
+        except BlockingIOError:
+            num_bytes = 0
+        except OSError:
+            # the file system does not support non-blocking reads
+            self._nowait_reads = False
+            num_bytes = 0
+
+        if num_bytes == size:
+            return memoryview(buffer)
+
+        return self._io_executor.submit(self._read_remaining, offset, buffer, num_bytes)
+
+    def _read_remaining(self, offset: int, buffer: ndarray, num_bytes: int) -> memoryview:
+        """
+        Complete a partial read of a byte range.
+        :param offset: position of the first byte of the range
+        :param buffer: buffer of the whole range
+        :param num_bytes: number of bytes already read
+        :return: view of the bytes read
+        """
+        num_bytes += self._readinto(offset + num_bytes, buffer[num_bytes:])
+
+        if num_bytes != len(buffer):
+            raise IOError(f'Expected to read {len(buffer)} bytes at offset {offset}, got {num_bytes}.')
+
+        return memoryview(buffer)
 
     def num_items(self) -> int:
         """
@@ -193,19 +778,15 @@ class File:
         """
         self.validate_file_handle('r')
 
-        self._fp.seek(0)
-        header_magic_bytes = self._fp.read(config.NUM_BYTES_MAGIC_BYTES)
+        header_magic_bytes, header_version, header_metadata_offset, header_metadata_length = \
+            config.HEADER_STRUCT.unpack(self._read(0, config.NUM_BYTES_HEADERS))
 
         if header_magic_bytes != config.MAGIC_BYTES:
-            raise ValueError(f'Expected magic bytes to be "{config.MAGIC_BYTES}", got "{header_magic_bytes}.')
-
-        header_version: AnyStr = self._fp.read(config.NUM_BYTES_VERSION)
-        header_metadata_offset: AnyStr = self._fp.read(config.NUM_BYTES_METADATA_OFFSET)
-        header_metadata_length: AnyStr = self._fp.read(config.NUM_BYTES_METADATA_LENGTH)
+            raise ValueError(f'Expected magic bytes to be "{config.MAGIC_BYTES}", got "{header_magic_bytes}".')
 
         self._version = self._version_to_string(header_version)
-        self._metadata_offset = np.frombuffer(header_metadata_offset, dtype=np.int64)[0]
-        self._metadata_length = np.frombuffer(header_metadata_length, dtype=np.int64)[0]
+        self._metadata_offset = header_metadata_offset
+        self._metadata_length = header_metadata_length
 
     def _write_headers(self):
         """
@@ -214,15 +795,11 @@ class File:
         """
         self.validate_file_handle('w')
 
-        header_version: AnyStr = self._version_to_bytes(self._version)
-        header_metadata_offset: AnyStr = np.array([self._metadata_offset], dtype=np.int64).tobytes()
-        header_metadata_length: AnyStr = np.array([self._metadata_length], dtype=np.int64).tobytes()
+        headers: AnyStr = config.HEADER_STRUCT.pack(config.MAGIC_BYTES, self._version_to_bytes(self._version),
+                                                     self._metadata_offset, self._metadata_length)
 
         self._fp.seek(0)
-        self._fp.write(config.MAGIC_BYTES)
-        self._fp.write(header_version)
-        self._fp.write(header_metadata_offset)
-        self._fp.write(header_metadata_length)
+        self._fp.write(headers)
 
     @staticmethod
     def create_array_metadata(offset: int, size: int, dtype: str):
@@ -247,28 +824,130 @@ class File:
         :return:
         """
         self.validate_file_handle('w')
+        self._add_item(item, validate=True)
+
+    def add_items(self, items: Iterable[Dict[str, ndarray]], validate: bool = True):
+        """
+        Write several items to the dataset.
+        :param items: iterable of dictionaries of (array name, array data) pairs
+        :param validate: check the types of the array names and values, only disable for trusted items
+        :return:
+        """
+        self.validate_file_handle('w')
+
+        for item in items:
+            self._add_item(item, validate)
+
+    def _add_item(self, item: Dict[str, ndarray], validate: bool):
+        """
+        Write an item to the dataset once the file handle has been validated.
+        :param item: dictionary of (array name, array data) pairs
+        :param validate: check the types of the array names and values
+        :return:
+        """
+        if validate:
+            # array names are only checked until they are part of the metadata
+            if self._metadata.metadata is None or item.keys() != self._metadata.metadata.keys():
+                for array_name in item.keys():
+                    if type(array_name) is not str:
+                        raise ValueError(f'Expected array_name type to be str, got {type(array_name)}.')
+            for array_value in item.values():
+                if type(array_value) is not ndarray:
+                    raise ValueError(f'Expected value type to be ndarray, got {type(array_value)}.')
 
         item_offset = self._item_offset
         metadata_item = dict()
+        arrays_serialized = []
+
+        try:
+            for array_name, array_value in item.items():
+                array_serialized, dtype = serialize_array(array_value)
+                array_size = len(array_serialized)
+                arrays_serialized.append(array_serialized)
+
+                array_offset = self._column_sizes.get(array_name, 0) if self._columnar else item_offset
+                # same dictionary as create_array_metadata, built inline as it is done for every array
+                metadata_item[array_name] = {'offset': array_offset, 'size': array_size, 'dtype': dtype}
+                item_offset += array_size
+
+            if self._columnar:
+                # offsets are relative to the column until the columns are laid out in the file on flush
+                self._metadata.add_item(metadata_item)
+                for array_name, array_serialized in zip(metadata_item.keys(), arrays_serialized):
+                    self._write_column(array_name, array_serialized)
+                return
+
+            self._write_buffers(arrays_serialized, self._item_offset, item_offset - self._item_offset)
+            self._metadata.add_item(metadata_item)
+        except Exception:
+            # rewind so that the next item overwrites the partially written one
+            self._fp.seek(self._item_offset)
+            raise
+
+        self._item_offset = item_offset
+
+    def _write_column(self, array_name: str, array_serialized: AnyStr):
+        """
+        Append a serialized array to the temporary file staging the arrays with the same name.
+        :param array_name: name of the array
+        :param array_serialized: serialized array
+        :return:
+        """
+        column_file = self._column_files.get(array_name)
+
+        if column_file is None:
+            column_file = tempfile.TemporaryFile(buffering=config.COLUMN_BUFFER_SIZE,
+                                                 dir=os.path.dirname(os.path.abspath(self._file_path)))
+            self._column_files[array_name] = column_file
+            self._column_sizes[array_name] = 0
+
+        column_file.write(array_serialized)
+        self._column_sizes[array_name] += len(array_serialized)
 
-        for array_name, array_value in item.items():
-            if type(array_name) is not str:
-                raise ValueError(f'Expected array_name type to be str, got {type(array_name)}.')
-            if type(array_value) is not ndarray:
-                raise ValueError(f'Expected value type to be ndarray, got {type(array_value)}.')
+    def _flush_columns(self):
+        """
+        Copy the staged columns to the file one after the other and make the array offsets absolute.
+        :return:
+        """
+        self._fp.seek(self._item_offset)
 
-            array_serialized, dtype = serialize_array(array_value)
+        for array_name, column_file in self._column_files.items():
+            column_file.seek(0)
+            shutil.copyfileobj(column_file, self._fp, config.WRITE_BUFFER_SIZE)
+            column_file.close()
 
-            self._fp.seek(item_offset)
-            self._fp.write(array_serialized)
+            self._metadata.shift_offsets(array_name, self._item_offset)
+            self._item_offset += self._column_sizes[array_name]
 
-            array_metadata = self.create_array_metadata(item_offset, len(array_serialized), dtype)
+        self._column_files.clear()
+        self._column_sizes.clear()
 
-            metadata_item[array_name] = array_metadata
-            item_offset += len(array_serialized)
+    def _write_buffers(self, buffers: List[AnyStr], offset: int, size: int):
+        """
+        Write several buffers contiguously at the current position of the file.
+        Large multi-buffer writes bypass the write buffer with a single gather call when `os.pwritev` is available.
+        :param buffers: list of bytes-like objects to write
+        :param offset: current position of the file
+        :param size: total size of the buffers
+        :return:
+        """
+        if size < config.WRITE_BUFFER_SIZE or not 1 < len(buffers) <= _IOV_MAX or not hasattr(os, 'pwritev'):
+            for buffer in buffers:
+                self._fp.write(buffer)
+            return
 
-        self._metadata.add_item(metadata_item)
-        self._item_offset = item_offset
+        self._fp.flush()
+        written = os.pwritev(self._fp.fileno(), buffers, offset)
+        self._fp.seek(offset + written)
+
+        # complete a short gather write through the buffered file object
+        for buffer in buffers:
+            buffer = memoryview(buffer).cast('B')
+            if written >= len(buffer):
+                written -= len(buffer)
+            else:
+                self._fp.write(buffer[written:])
+                written = 0
 
     @staticmethod
     def _version_to_string(version_bytes: bytes) -> str:
@@ -277,7 +956,7 @@ class File:
         :param version_bytes: 4-byte array representation of the version number
         :return: string version with format "x.y.z"
         """
-        return '.'.join([str(x) for x in np.frombuffer(version_bytes, dtype=np.uint8)[1:]])
+        return '.'.join([str(x) for x in version_bytes[1:config.NUM_BYTES_VERSION]])
 
     @staticmethod
     def _version_to_bytes(version_string: str) -> bytes:
@@ -286,7 +965,13 @@ class File:
         :param version_string: string version number of format "x.y.z"
         :return: 4-byte array representation of the version number
         """
-        return np.array([0] + [int(s) for s in version_string.split('.')], dtype=np.uint8).tobytes()
+        version_numbers = [int(s) for s in version_string.split('.')]
+
+        if len(version_numbers) != config.NUM_BYTES_VERSION - 1:
+            raise ValueError(f'Expected version number of format "x.y.z", got "{version_string}".')
+
+        # bytes() also rejects numbers out of the [0, 255] range
+        return bytes([0] + version_numbers)
 
     def _flush(self):
         """
@@ -298,6 +983,9 @@ class File:
         if self._mode != 'w':
             raise IOError(f'File is expected to be opened in write mode, got {self._mode}.')
 
+        if self._columnar:
+            self._flush_columns()
+
         metadata_serialized: AnyStr = self._metadata.tobytes()
 
         self._metadata_offset = self._item_offset
@@ -16,13 +16,19 @@
     You should have received a copy of the GNU General Public License
     along with Syrah.  If not, see <https://www.gnu.org/licenses/>.
 """
-from typing import Union, Dict, AnyStr, Optional, Any, Tuple
+from typing import Union, Dict, AnyStr, Optional, Any, Tuple, List, Sequence, Callable
+from collections import OrderedDict
 from numpy import ndarray
 
 import numpy as np
 import bson
 import multiprocessing as mp
 import ctypes
+import sys
+import struct
+import threading
+
+from .. import config
 
 
 """
@@ -36,6 +42,17 @@ metadata_types = {
     'dtype': str
 }
 
+"""
+    Keys expected in the metadata of each array
+"""
+_METADATA_KEYS = frozenset(metadata_types)
+
+"""
+    Keys of the list metadata (in the order of their rows for each array) and of the scalar metadata
+"""
+_LIST_METADATA_KEYS = tuple(key for key, value in metadata_types.items() if isinstance(value, list))
+_SCALAR_METADATA_KEYS = tuple(key for key, value in metadata_types.items() if not isinstance(value, list))
+
 metadata_ctypes = {
     'offset': [ctypes.c_int64],
     'size': [ctypes.c_int64],
@@ -43,6 +60,210 @@ metadata_ctypes = {
 }
 
 
+"""
+    Little endian 32 bits integer used for the sizes in BSON documents
+"""
+_BSON_INT32 = struct.Struct('<i')
+_BSON_INT64 = struct.Struct('<q')
+
+
+def _bson_encode(document: Dict[AnyStr, Any], parts: List[Any]) -> int:
+    """
+    Append the BSON serialization of a document to a list of byte strings.
+    Binary values are appended as is to be copied only once when joining the parts.
+    :param document: document of (nested) documents, binaries, strings and integers
+    :param parts: list of serialized parts to append to
+    :return: size of the serialized document
+    """
+    size_index = len(parts)
+    parts.append(None)
+    size = _BSON_INT32.size + 1
+
+    for key, value in document.items():
+        key_serialized = key.encode('utf-8') + b'\x00'
+
+        if isinstance(value, dict):
+            parts.append(b'\x03' + key_serialized)
+            size += len(parts[-1]) + _bson_encode(value, parts)
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            nbytes = memoryview(value).nbytes
+            parts.append(b'\x05' + key_serialized + _BSON_INT32.pack(nbytes) + b'\x00')
+            parts.append(value)
+            size += len(parts[-2]) + nbytes
+        elif isinstance(value, str):
+            value_serialized = value.encode('utf-8') + b'\x00'
+            parts.append(b'\x02' + key_serialized + _BSON_INT32.pack(len(value_serialized)) + value_serialized)
+            size += len(parts[-1])
+        elif isinstance(value, int) and not isinstance(value, bool) and -2 ** 31 <= value < 2 ** 31:
+            parts.append(b'\x10' + key_serialized + _BSON_INT32.pack(value))
+            size += len(parts[-1])
+        elif isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63:
+            parts.append(b'\x12' + key_serialized + _BSON_INT64.pack(value))
+            size += len(parts[-1])
+        else:
+            raise TypeError(f'Unsupported metadata value type: {type(value)}.')
+
+    parts.append(b'\x00')
+    parts[size_index] = _BSON_INT32.pack(size)
+
+    return size
+
+
+def _bson_dumps(document: Dict[AnyStr, Any]) -> bytes:
+    """
+    Serialize the metadata into BSON, falling back to the bson module for unsupported value types.
+    :param document: metadata document
+    :return: serialized metadata
+    """
+    parts = []
+    try:
+        _bson_encode(document, parts)
+    except TypeError:
+        return bson.dumps(document)
+
+    return b''.join(parts)
+
+
+def _bson_cstring_end(serialized: memoryview, position: int) -> int:
+    """
+    Find the end of a null terminated string (e.g. an element key) in a BSON buffer.
+    :param serialized: serialized document
+    :param position: position of the first character
+    :return: position of the null byte
+    """
+    while serialized[position] != 0x00:
+        position += 1
+
+    return position
+
+
+def _bson_decode(serialized: memoryview, position: int) -> Tuple[Dict[AnyStr, Any], int]:
+    """
+    Deserialize a BSON document of (nested) documents, binaries, strings and integers.
+    Binary values are returned as views of the serialized buffer.
+    :param serialized: serialized document
+    :param position: position of the document in the buffer
+    :return: deserialized document and position of the first byte after it
+    """
+    size, = _BSON_INT32.unpack_from(serialized, position)
+    end = position + size
+    position += _BSON_INT32.size
+    document = dict()
+
+    while serialized[position] != 0x00:
+        element_type = serialized[position]
+        key_end = _bson_cstring_end(serialized, position + 1)
+        key = str(serialized[position + 1:key_end], encoding='utf-8')
+        position = key_end + 1
+
+        if element_type == 0x03:
+            document[key], position = _bson_decode(serialized, position)
+        elif element_type == 0x05:
+            nbytes, = _BSON_INT32.unpack_from(serialized, position)
+            position += _BSON_INT32.size + 1
+            document[key] = serialized[position:position + nbytes]
+            position += nbytes
+        elif element_type == 0x02:
+            nbytes, = _BSON_INT32.unpack_from(serialized, position)
+            position += _BSON_INT32.size
+            document[key] = str(serialized[position:position + nbytes - 1], encoding='utf-8')
+            position += nbytes
+        elif element_type == 0x10:
+            document[key], = _BSON_INT32.unpack_from(serialized, position)
+            position += _BSON_INT32.size
+        elif element_type == 0x12:
+            document[key], = _BSON_INT64.unpack_from(serialized, position)
+            position += _BSON_INT64.size
+        else:
+            raise ValueError(f'Unsupported BSON element type: {element_type}.')
+
+    if position + 1 != end:
+        raise ValueError('Inconsistent BSON document size.')
+
+    return document, end
+
+
+def _bson_loads(serialized: memoryview) -> Dict[AnyStr, Any]:
+    """
+    Deserialize BSON metadata, falling back to the bson module for unsupported value types.
+    :param serialized: serialized metadata
+    :return: metadata document
+    """
+    try:
+        document, _ = _bson_decode(serialized, 0)
+    except (ValueError, IndexError, struct.error):
+        return bson.loads(bytes(serialized))
+
+    return document
+
+
+"""
+    Size of the fixed size BSON values by element type (double, undefined, object id, boolean, datetime, null,
+    int32, timestamp, int64, decimal128, min key and max key)
+"""
+_BSON_FIXED_SIZES = {0x01: 8, 0x06: 0, 0x07: 12, 0x08: 1, 0x09: 8, 0x0A: 0, 0x10: 4, 0x11: 8, 0x12: 8, 0x13: 16,
+                     0xFF: 0, 0x7F: 0}
+
+
+def _bson_skip(serialized: bytes, element_type: int, position: int) -> int:
+    """
+    Skip a BSON value without decoding it.
+    :param serialized: serialized document
+    :param element_type: BSON type of the value
+    :param position: position of the value in the buffer
+    :return: position of the first byte after the value
+    """
+    if element_type in _BSON_FIXED_SIZES:
+        return position + _BSON_FIXED_SIZES[element_type]
+
+    size, = _BSON_INT32.unpack_from(serialized, position)
+
+    if element_type in (0x03, 0x04, 0x0F):
+        # document, array and code with scope: size includes itself
+        return position + size
+    if element_type in (0x02, 0x0D, 0x0E):
+        # string, code and symbol: size, then bytes (including trailing null byte)
+        return position + _BSON_INT32.size + size
+    if element_type == 0x05:
+        # binary: size, subtype, then bytes
+        return position + _BSON_INT32.size + 1 + size
+
+    raise ValueError(f'Unsupported BSON element type: {element_type}.')
+
+
+def _count_items(serialized: memoryview) -> Optional[int]:
+    """
+    Get the number of items from serialized metadata without deserializing it.
+    Walks the BSON document up to the offsets of the first array key.
+    :param serialized: serialized metadata
+    :return: number of items, None if it could not be found
+    """
+    try:
+        # top level document: size, then first element which is the (embedded document) metadata of an array key
+        if serialized[4] == 0x00:
+            return 0
+        if serialized[4] != 0x03:
+            return None
+        position = _bson_cstring_end(serialized, 5) + 1 + 4
+
+        # elements of the array metadata: type, key, value
+        while serialized[position] != 0x00:
+            element_type = serialized[position]
+            key_end = _bson_cstring_end(serialized, position + 1)
+            key = serialized[position + 1:key_end]
+            position = key_end + 1
+
+            if element_type == 0x05 and key == b'offset':
+                size, = _BSON_INT32.unpack_from(serialized, position)
+                return size // np.dtype(metadata_types['offset'][0]).itemsize
+
+            position = _bson_skip(serialized, element_type, position)
+    except (IndexError, ValueError, struct.error):
+        pass
+
+    return None
+
+
 class MpNdArray:
     """
     Container for a multiprocessing multi-dimensional array.
@@ -52,9 +273,34 @@ class MpNdArray:
         Create a new multiprocessing multi-dimensional array.
         :param array: array to wrap with multiprocessing container
         """
-        self.shape = array.shape
-        self.dtype = array.dtype
-        self.data = mp.RawArray(self.dtype.char, array.ravel())
+        self._allocate(array.shape, array.dtype)
+        # single copy from the source (of any layout) into the shared memory
+        np.copyto(self.array, array)
+
+    @classmethod
+    def empty(cls, shape: Tuple[int, ...], dtype: Union[str, np.dtype]) -> 'MpNdArray':
+        """
+        Create a new multiprocessing multi-dimensional array without initializing it from an existing array.
+        :param shape: shape of the array
+        :param dtype: type of the array
+        :return: multiprocessing array to be filled through its numpy view
+        """
+        mp_array = cls.__new__(cls)
+        mp_array._allocate(shape, dtype)
+
+        return mp_array
+
+    def _allocate(self, shape: Tuple[int, ...], dtype: Union[str, np.dtype]):
+        """
+        Allocate the shared memory of the array and its numpy view.
+        :param shape: shape of the array
+        :param dtype: type of the array
+        :return:
+        """
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.data = mp.RawArray(self.dtype.char, int(np.prod(self.shape)))
+        self.array: ndarray = np.frombuffer(self.data, dtype=self.dtype).reshape(self.shape)
 
     def __getitem__(self, index: Tuple[int, ...]) -> Any:
         """
@@ -62,7 +308,18 @@ class MpNdArray:
         :param index: index of the item
         :return:
         """
-        return self.data[np.ravel_multi_index(index, dims=self.shape)]
+        # served by the numpy view of the shared memory rather than element-wise ctypes access
+        return self.array.item(index)
+
+    def get_range(self, row: int, start: int, stop: int) -> ndarray:
+        """
+        Get a range of consecutive items of a row of the (2-D) array.
+        :param row: index of the row
+        :param start: index of the first item
+        :param stop: index after the last item
+        :return: view of the items in the shared memory
+        """
+        return self.array[row, start:stop]
 
 
 class MetadataWriter:
@@ -76,6 +333,11 @@ class MetadataWriter:
         self.metadata: Optional[Dict[AnyStr, Dict[AnyStr, Any]]] = None
         self.data: Optional[ndarray] = None
         self.length: int = 0
+        self._row_of: Dict[Tuple[AnyStr, AnyStr], int] = dict()
+        self._scalars: List[Tuple[AnyStr, AnyStr]] = []
+        self._scalar_values: List[Any] = []
+        self._scalar_shell: Dict[AnyStr, Dict[AnyStr, Any]] = dict()
+        self._serialized: Optional[bytes] = None
 
     def __len__(self) -> int:
         """
@@ -86,65 +348,140 @@ class MetadataWriter:
 
     def add_item(self, item_metadata: Dict[AnyStr, Dict[AnyStr, int]]):
         """
-        Add a new item to the metadata.
+        Add a new item to the metadata, same as add_items([item_metadata]) without building a batch.
         :param item_metadata: dictionary of array metadata
         :return:
         """
         if self.length == 0:
             self._init_metadata(item_metadata)
 
-        if set(item_metadata.keys()) != set(self.metadata.keys()):
+        if item_metadata.keys() != self.metadata.keys():
             raise KeyError('Array keys not consistent with previous metadata.')
+        self._check_metadata(item_metadata)
 
-        self._append_metadata(item_metadata)
+        if self.length == self.data.shape[1]:
+            self._grow()
+
+        # values in row order, stored with a single assignment to the column of the item
+        self.data[:, self.length] = [item_metadata[array_key][metadata_key] for array_key, metadata_key in self._row_of]
 
         self.length += 1
+        self._serialized = None
+
+    def add_items(self, items_metadata: Sequence[Dict[AnyStr, Dict[AnyStr, int]]]):
+        """
+        Add several items to the metadata, their values are stored with a single assignment.
+        All the items are checked before any of them is added.
+        :param items_metadata: sequence of dictionaries of array metadata
+        :return:
+        """
+        if len(items_metadata) == 0:
+            return
+
+        if self.length == 0:
+            self._init_metadata(items_metadata[0])
+
+        for item_metadata in items_metadata:
+            if item_metadata.keys() != self.metadata.keys():
+                raise KeyError('Array keys not consistent with previous metadata.')
+            self._check_metadata(item_metadata)
+
+        length = self.length + len(items_metadata)
+        while length > self.data.shape[1]:
+            self._grow()
+
+        # values in row order, one column per item
+        self.data[:, self.length:length] = np.array(
+            [[item_metadata[array_key][metadata_key] for array_key, metadata_key in self._row_of]
+             for item_metadata in items_metadata], dtype=self.data.dtype).T
+
+        self.length = length
+        self._serialized = None
 
     def _init_metadata(self, item_metadata: Dict[AnyStr, Dict[AnyStr, int]]):
         self.metadata = dict()
-        self.data = []
+        self._row_of = dict()
+        self._scalars = []
+        self._scalar_values = []
+        self._scalar_shell = dict()
 
         for array_index, (array_key, array_metadata) in enumerate(item_metadata.items()):
-            if set(array_metadata.keys()) != set(metadata_types.keys()):
+            if array_metadata.keys() != _METADATA_KEYS:
                 raise KeyError(f'Metadata keys: {", ".join(array_metadata.keys())} do not match:'
                                f' {", ".join(metadata_types.keys())}.')
 
             self.metadata[array_key] = dict()
-            for metadata_index, metadata_key in enumerate(metadata_types.keys()):
-                if isinstance(metadata_types[metadata_key], list):
-                    self.metadata[array_key][metadata_key] = len(self.data)
-                    self.data.append([])
-                else:
-                    self.metadata[array_key][metadata_key] = array_metadata[metadata_key]
-
-    def _append_metadata(self, item_metadata: Dict[AnyStr, Dict[AnyStr, int]]):
-        for array_index, (array_key, array_metadata) in enumerate(item_metadata.items()):
-            if set(array_metadata.keys()) != set(metadata_types.keys()):
+            for metadata_key in _LIST_METADATA_KEYS:
+                self.metadata[array_key][metadata_key] = len(self._row_of)
+                self._row_of[(array_key, metadata_key)] = len(self._row_of)
+            for metadata_key in _SCALAR_METADATA_KEYS:
+                self.metadata[array_key][metadata_key] = array_metadata[metadata_key]
+                self._scalars.append((array_key, metadata_key))
+                self._scalar_values.append(array_metadata[metadata_key])
+            # scalar metadata never change, their serialized form is built once
+            self._scalar_shell[array_key] = {metadata_key: array_metadata[metadata_key]
+                                             for metadata_key in _SCALAR_METADATA_KEYS}
+
+        # one row per (array key, list metadata) pair, one column per item, grown by doubling
+        self.data = np.empty((len(self._row_of), config.METADATA_INITIAL_CAPACITY), dtype=np.int64)
+
+    def _grow(self):
+        """
+        Double the number of items that can be stored before reallocating.
+        :return:
+        """
+        data = np.empty((self.data.shape[0], 2 * self.data.shape[1]), dtype=self.data.dtype)
+        data[:, :self.length] = self.data[:, :self.length]
+        self.data = data
+
+    def _check_metadata(self, item_metadata: Dict[AnyStr, Dict[AnyStr, int]]):
+        for array_key, array_metadata in item_metadata.items():
+            if array_metadata.keys() != _METADATA_KEYS:
                 raise KeyError(f'Metadata keys: {", ".join(array_metadata.keys())} do not match:'
                                f' {", ".join(metadata_types.keys())}.')
 
-            for metadata_index, metadata_key in enumerate(metadata_types.keys()):
-                if isinstance(metadata_types[metadata_key], list):
-                    self.data[self.metadata[array_key][metadata_key]].append(array_metadata[metadata_key])
-                else:
-                    if array_metadata[metadata_key] != self.metadata[array_key][metadata_key]:
-                        raise ValueError(f'{metadata_key} value {array_metadata[metadata_key]} not consistent with previous values {self.metadata[array_key][metadata_key]}')
+        # compared at once, the inconsistent value is only searched for when the check fails
+        scalar_values = [item_metadata[array_key][metadata_key] for array_key, metadata_key in self._scalars]
+        if scalar_values != self._scalar_values:
+            array_key, metadata_key = next(scalar for scalar, value, previous_value
+                                           in zip(self._scalars, scalar_values, self._scalar_values)
+                                           if value != previous_value)
+            raise ValueError(f'{metadata_key} value {item_metadata[array_key][metadata_key]} not consistent with '
+                             f'previous values {self.metadata[array_key][metadata_key]}')
+
+    def shift_offsets(self, array_key: AnyStr, delta: int):
+        """
+        Shift the offsets of all the arrays with the given key.
+        :param array_key: key of array
+        :param delta: value added to each offset
+        :return:
+        """
+        self.data[self.metadata[array_key]['offset'], :self.length] += delta
+        self._serialized = None
 
     def tobytes(self) -> AnyStr:
         """
         Serializes the metadata.
+        The result is kept until the metadata is modified.
         :return: serialized metadata
         """
+        if self._serialized is not None:
+            return self._serialized
+
+        # list metadata come first in metadata_types, the key order of the documents is kept
         metadata_serialized = dict()
-        for array_key in self.metadata.keys():
-            metadata_serialized[array_key] = dict()
-            for metadata_key in metadata_types.keys():
-                if isinstance(metadata_types[metadata_key], list):
-                    metadata_serialized[array_key][metadata_key] = np.array(self.data[self.metadata[array_key][metadata_key]], dtype=metadata_types[metadata_key][0]).tobytes()
-                else:
-                    metadata_serialized[array_key][metadata_key] = self.metadata[array_key][metadata_key]
+        for array_key, scalar_shell in self._scalar_shell.items():
+            array_serialized = dict()
+            for metadata_key in _LIST_METADATA_KEYS:
+                row = self.data[self.metadata[array_key][metadata_key], :self.length]
+                array_serialized[metadata_key] = memoryview(
+                    row.astype(metadata_types[metadata_key][0], copy=False)).cast('B')
+            array_serialized.update(scalar_shell)
+            metadata_serialized[array_key] = array_serialized
+
+        self._serialized = _bson_dumps(metadata_serialized)
 
-        return bson.dumps(metadata_serialized)
+        return self._serialized
 
 
 class MetadataReader:
@@ -156,9 +493,19 @@ class MetadataReader:
         Create a new metadata reader object and initialize it if necessary.
         :param serialized: serialized metadata for initialization
         """
-        self.metadata: Optional[Dict[AnyStr, Dict[AnyStr, Any]]] = None
-        self.data: Optional[MpNdArray] = None
+        self._serialized: Optional[memoryview] = None
+        self._metadata: Optional[Dict[AnyStr, Dict[AnyStr, Any]]] = None
+        self._data: Optional[MpNdArray] = None
+        self._columns: Optional[Dict[AnyStr, Dict[AnyStr, ndarray]]] = None
+        self._keys: Optional[List[AnyStr]] = None
+        self._key_index: Optional[Dict[AnyStr, int]] = None
+        self._offsets: Optional[ndarray] = None
+        self._sizes: Optional[ndarray] = None
+        self._dtypes: Optional[List[str]] = None
+        self._lock = threading.Lock()
         self.length: int = 0
+        self._item_cache: OrderedDict = OrderedDict()
+        self._fixed_sizes: Dict[AnyStr, Optional[int]] = dict()
 
         if serialized is not None:
             self.frombuffer(serialized)
@@ -170,28 +517,110 @@ class MetadataReader:
         """
         return self.length
 
+    @property
+    def metadata(self) -> Optional[Dict[AnyStr, Dict[AnyStr, Any]]]:
+        """
+        Metadata of each array key, list metadata are replaced by their row index in the data.
+        """
+        if self._serialized is not None:
+            self._deserialize()
+        return self._metadata
+
+    @property
+    def data(self) -> Optional[MpNdArray]:
+        """
+        Values of the list metadata, one row per array key and list metadata.
+        """
+        if self._serialized is not None:
+            self._deserialize()
+        return self._data
+
+    @property
+    def columns(self) -> Optional[Dict[AnyStr, Dict[AnyStr, ndarray]]]:
+        """
+        Values of the list metadata for each array key and list metadata.
+        """
+        if self._serialized is not None:
+            self._deserialize()
+        return self._columns
+
     def frombuffer(self, serialized: AnyStr):
         """
-        Deserialize metadata given as an argument.
-        :param serialized: serialized metadata
+        Load metadata given as an argument.
+        Only the number of items is read, the metadata is deserialized on first access.
+        :param serialized: serialized metadata (any bytes-like object, referenced without copy until deserialized)
         :return:
         """
-        metadata_serialized = bson.loads(serialized)
-        self.metadata = dict()
-        arrays_list = []
-
-        for array_key in metadata_serialized.keys():
-            self.metadata[array_key] = dict()
-            for metadata_key in metadata_types.keys():
-                if isinstance(metadata_types[metadata_key], list):
-                    self.metadata[array_key][metadata_key] = len(arrays_list)
-                    arrays_list.append(np.frombuffer(metadata_serialized[array_key][metadata_key],
-                                                     dtype=metadata_types[metadata_key][0]))
-                else:
-                    self.metadata[array_key][metadata_key] = metadata_serialized[array_key][metadata_key]
+        self._serialized = memoryview(serialized).cast('B')
+        self._metadata = None
+        self._data = None
+        self._columns = None
+        self._item_cache.clear()
+        self._fixed_sizes.clear()
+
+        length = _count_items(self._serialized)
+        if length is None:
+            self._deserialize()
+        else:
+            self.length = length
 
-        self.data = MpNdArray(np.array(arrays_list))
-        self.length = len(arrays_list[0])
+    def _deserialize(self):
+        """
+        Deserialize the loaded metadata.
+        :return:
+        """
+        with self._lock:
+            if self._serialized is None:
+                return
+
+            metadata_serialized = _bson_loads(self._serialized)
+            metadata = dict()
+            data = None
+
+            # array keys are interned, so that they are found by identity when looked up with interned names
+            for array_index, array_key in enumerate(map(sys.intern, metadata_serialized.keys())):
+                metadata[array_key] = dict()
+                for list_index, metadata_key in enumerate(_LIST_METADATA_KEYS):
+                    row = np.frombuffer(metadata_serialized[array_key][metadata_key],
+                                        dtype=metadata_types[metadata_key][0])
+
+                    # rows are copied once, straight into the shared memory allocated when the number of items is known
+                    if data is None:
+                        data = MpNdArray.empty((len(metadata_serialized) * len(_LIST_METADATA_KEYS), len(row)),
+                                               row.dtype)
+
+                    metadata[array_key][metadata_key] = array_index * len(_LIST_METADATA_KEYS) + list_index
+                    data.array[metadata[array_key][metadata_key]] = row
+                for metadata_key in _SCALAR_METADATA_KEYS:
+                    metadata_value = metadata_serialized[array_key][metadata_key]
+                    # scalar strings (e.g. dtype) are compared and hashed for every array read
+                    if isinstance(metadata_value, str):
+                        metadata_value = sys.intern(metadata_value)
+                    metadata[array_key][metadata_key] = metadata_value
+
+            # a file without items has no arrays: empty tables
+            if data is None:
+                data = MpNdArray.empty((0, 0), metadata_types[_LIST_METADATA_KEYS[0]][0])
+
+            # per array views of the shared rows: one contiguous column per list metadata (e.g. offsets, sizes)
+            self._columns = {
+                array_key: {
+                    metadata_key: data.array[array_metadata[metadata_key]] for metadata_key in _LIST_METADATA_KEYS
+                }
+                for array_key, array_metadata in metadata.items()
+            }
+
+            # (array, item) tables: rows are laid out array by array, in the order of the list metadata types
+            self._keys = list(metadata.keys())
+            self._key_index = {array_key: array_index for array_index, array_key in enumerate(self._keys)}
+            self._offsets = data.array[_LIST_METADATA_KEYS.index('offset')::len(_LIST_METADATA_KEYS)]
+            self._sizes = data.array[_LIST_METADATA_KEYS.index('size')::len(_LIST_METADATA_KEYS)]
+            self._dtypes = [metadata[array_key]['dtype'] for array_key in self._keys]
+
+            self._metadata = metadata
+            self._data = data
+            self.length = data.shape[1]
+            self._serialized = None
 
     def get(self, item: int, array_key: AnyStr, metadata_key: AnyStr) -> Any:
         """
@@ -202,8 +631,118 @@ class MetadataReader:
         :return: value of the metadata
         """
         if isinstance(metadata_types[metadata_key], list):
-            metadata_value = self.data[self.metadata[array_key][metadata_key], item]
+            metadata_value = self.columns[array_key][metadata_key][item]
         else:
             metadata_value = self.metadata[array_key][metadata_key]
 
         return metadata_value
+
+    def bind(self, array_key: AnyStr, metadata_key: AnyStr) -> Callable[[int], Any]:
+        """
+        Get a function returning the metadata of the specified array and metadata key for a given item.
+        The keys are looked up once, e.g. to get the metadata of many items in a loop.
+        :param array_key: key of array
+        :param metadata_key: key of metadata
+        :return: function of the index of the item returning the value of the metadata
+        """
+        if isinstance(metadata_types[metadata_key], list):
+            # returns python scalars, as get() would
+            return self.columns[array_key][metadata_key].item
+
+        metadata_value = self.metadata[array_key][metadata_key]
+
+        return lambda item: metadata_value
+
+    def iter_item(self, item: int) -> List[Tuple[AnyStr, int, int, str]]:
+        """
+        Get the metadata of all the arrays of the specified item.
+        The result is cached for the last accessed items.
+        :param item: index of item
+        :return: list of (array key, offset, size, dtype) tuples
+        """
+        item_arrays = self._item_cache.get(item)
+
+        if item_arrays is not None:
+            try:
+                self._item_cache.move_to_end(item)
+            except KeyError:
+                # evicted concurrently by another File sharing this (cached) metadata
+                pass
+            return item_arrays
+
+        if self._serialized is not None:
+            self._deserialize()
+
+        item_arrays = list(zip(self._keys, self._offsets[:, item].tolist(), self._sizes[:, item].tolist(),
+                               self._dtypes))
+
+        self._item_cache[item] = item_arrays
+        if len(self._item_cache) > config.METADATA_ITEM_CACHE_SIZE:
+            try:
+                self._item_cache.popitem(last=False)
+            except KeyError:
+                pass
+
+        return item_arrays
+
+    def iter_items(self, items: Sequence[int],
+                   array_keys: Optional[Sequence[AnyStr]] = None) -> List[List[Tuple[AnyStr, int, int, str]]]:
+        """
+        Get the metadata of the arrays of several items, with a single lookup in each table.
+        The result is not cached.
+        :param items: indices of items
+        :param array_keys: keys of the arrays (all of them if None)
+        :return: list of lists of (array key, offset, size, dtype) tuples, one list per item
+        """
+        if self._serialized is not None:
+            self._deserialize()
+
+        items = np.asarray(items, dtype=np.int64)
+
+        if array_keys is None:
+            keys, dtypes = self._keys, self._dtypes
+            offsets = self._offsets[:, items].T.tolist()
+            sizes = self._sizes[:, items].T.tolist()
+        else:
+            rows = []
+            for array_key in array_keys:
+                if array_key not in self._key_index:
+                    raise KeyError(f'Key {array_key} could not be found in metadata.')
+                rows.append(self._key_index[array_key])
+
+            keys, dtypes = list(array_keys), [self._dtypes[row] for row in rows]
+            # only the requested (array, item) cells are gathered, not whole rows
+            offsets = self._offsets[np.ix_(rows, items)].T.tolist()
+            sizes = self._sizes[np.ix_(rows, items)].T.tolist()
+
+        return [list(zip(keys, item_offsets, item_sizes, dtypes))
+                for item_offsets, item_sizes in zip(offsets, sizes)]
+
+    def locate(self, item: int, array_key: AnyStr) -> Tuple[int, int, str]:
+        """
+        Get the position, size and type of the specified array.
+        :param item: index of item
+        :param array_key: key of array
+        :return: (offset, size, dtype) tuple
+        """
+        if self._serialized is not None:
+            self._deserialize()
+
+        array_index = self._key_index.get(array_key)
+
+        if array_index is None:
+            raise KeyError(f'Key {array_key} could not be found in metadata.')
+
+        return self._offsets.item(array_index, item), self._sizes.item(array_index, item), self._dtypes[array_index]
+
+    def get_fixed_size(self, array_key: AnyStr) -> Optional[int]:
+        """
+        Get the size shared by all the arrays with the given key.
+        :param array_key: key of array
+        :return: size of the serialized arrays, None if the arrays have different sizes
+        """
+        if array_key not in self._fixed_sizes:
+            sizes = self.columns[array_key]['size']
+            self._fixed_sizes[array_key] = int(sizes[0]) if len(sizes) > 0 and np.all(sizes == sizes[0]) else None
+
+        return self._fixed_sizes[array_key]
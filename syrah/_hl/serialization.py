@@ -16,7 +16,7 @@
     You should have received a copy of the GNU General Public License
     along with Syrah.  If not, see <https://www.gnu.org/licenses/>.
 """
-from typing import AnyStr, Tuple
+from typing import AnyStr, Tuple, Union
 from numpy import ndarray
 from numpy import dtype
 
@@ -49,6 +49,29 @@ Supported types by name
 """
 dtype_names = {value: key for key, value in dtypes.items()}
 
+"""
+Supported numeric types by numpy type object
+"""
+_dtype_objects = dict()
+
+"""
+Numpy type objects of the supported numeric types by name, so that type names are parsed only once
+"""
+_dtype_objects_by_name = dict()
+for _dtype_name in dtype_names:
+    try:
+        if _dtype_name != 'str':
+            _dtype_objects[np.dtype(_dtype_name)] = _dtype_name
+            _dtype_objects_by_name[_dtype_name] = np.dtype(_dtype_name)
+    except TypeError:
+        # e.g. float128 is not available on every platform
+        pass
+
+"""
+Memory alignment of the supported numeric types by name
+"""
+dtype_alignments = {name: dtype_object.alignment for name, dtype_object in _dtype_objects_by_name.items()}
+
 
 def dtype_to_string(data_type: dtype) -> str:
     """
@@ -57,6 +80,11 @@ def dtype_to_string(data_type: dtype) -> str:
     :param data_type: numpy array type
     :return: type in string format
     """
+    # single lookup for the numeric types, also matching aliases with another type number (e.g. longlong)
+    data_type_name = _dtype_objects.get(data_type)
+    if data_type_name is not None:
+        return data_type_name
+
     dtype_num = data_type.num
 
     if dtype_num not in dtypes:
@@ -70,33 +98,56 @@ def deserialize_array(array_serialized: AnyStr, data_type: str) -> ndarray:
     Deserialize an array using the given type from a little endian encoded byte string.
     If the specified type is a string it is assumed that the array contains only one element
     (i.e. decoded as a char array).
-    :param array_serialized: serialized array as byte string
+    :param array_serialized: serialized array as byte string (or any bytes-like object)
     :param data_type: type of the resulting array
     :return: numpy array of the specified type
     """
-    if data_type not in dtype_names:
+    dtype_object = _dtype_objects_by_name.get(data_type)
+    if dtype_object is not None:
+        return np.frombuffer(array_serialized, dtype=dtype_object)
+
+    if data_type != 'str':
         raise TypeError(f'Type {data_type} is not supported. Supported types are: {", ".join(dtype_names.keys())}')
 
-    if data_type == 'str':
-        string = array_serialized.decode('utf-8')
-        return np.array([string])
-    else:
-        array = np.frombuffer(array_serialized, dtype=data_type)
+    string = str(array_serialized, encoding='utf-8')
+    return np.array([string])
+
+
+def empty_array(size: int, data_type: str) -> ndarray:
+    """
+    Allocate an uninitialized array of the given type large enough to hold `size` bytes of serialized data,
+    so that the data can be read directly into it.
+    :param size: size of the serialized array in bytes
+    :param data_type: type of the array (any supported type except "str")
+    :return: uninitialized numpy array of the specified type
+    """
+    dtype_object = _dtype_objects_by_name.get(data_type)
+    if dtype_object is None:
+        raise TypeError(f'Type {data_type} cannot be read into a preallocated array.')
+
+    itemsize = dtype_object.itemsize
+
+    if size % itemsize != 0:
+        raise ValueError(f'Serialized size {size} is not a multiple of the size of type {data_type}.')
 
-    return array
+    return np.empty(size // itemsize, dtype=dtype_object)
 
 
-def serialize_array(array: ndarray) -> Tuple[AnyStr, str]:
+def serialize_array(array: ndarray) -> Tuple[Union[bytes, memoryview], str]:
     """
     Serialize a numpy array to a little endian encoded byte string.
+    Numeric arrays are returned as a byte view of the (C-contiguous) array data instead of a copy,
+    the view is only valid as long as the array is not modified.
     :param array: numpy array
-    :return: serialized array and corresponding array type
+    :return: serialized array (bytes-like object) and corresponding array type
     """
     data_type = dtype_to_string(array.dtype)
 
     if data_type == 'str':
-        array_serialized = bytes(''.join(array), encoding='utf-8')
+        # joining python strings (rather than numpy scalars) then encoding once, also works for 0-d arrays
+        array_serialized = ''.join(array.reshape(-1).tolist()).encode('utf-8')
     else:
-        array_serialized = array.tobytes()
+        # no copy unless the array is not C-contiguous (e.g. transposed or strided views)
+        array_serialized = memoryview(np.ascontiguousarray(array)).cast('B')
 
     return array_serialized, data_type
@@ -16,6 +16,7 @@
     You should have received a copy of the GNU General Public License
     along with Syrah.  If not, see <https://www.gnu.org/licenses/>.
 """
+import struct
 
 """
     Magic byte for format identification
@@ -38,3 +39,45 @@ NUM_BYTES_METADATA_LENGTH = 8
     Number of magic bytes.
 """
 NUM_BYTES_MAGIC_BYTES = len(MAGIC_BYTES)
+"""
+    Binary layout of the headers: magic bytes, version, metadata offset and metadata length (little endian int64),
+    packed and unpacked with a single call.
+"""
+HEADER_STRUCT = struct.Struct(f'<{NUM_BYTES_MAGIC_BYTES}s{NUM_BYTES_VERSION}sqq')
+"""
+    Number of bytes of the headers, i.e. position of the first array.
+"""
+NUM_BYTES_HEADERS = HEADER_STRUCT.size
+"""
+    Size in bytes of the write buffer used when creating a file.
+"""
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+"""
+    Size in bytes of the write buffer of each temporary file staging the arrays of a given name in columnar layout.
+"""
+COLUMN_BUFFER_SIZE = 1024 * 1024
+"""
+    Maximum number of unrequested bytes between two byte ranges for them to be fetched with a single read.
+"""
+READ_MERGE_GAP = 4096
+"""
+    Number of items whose array metadata is cached by the metadata reader.
+"""
+METADATA_ITEM_CACHE_SIZE = 1024
+"""
+    Number of items for which the metadata writer initially allocates storage, doubled whenever it is full.
+"""
+METADATA_INITIAL_CAPACITY = 1024
+"""
+    Number of files whose deserialized metadata is kept in memory to speed up reopening them (0 to disable).
+"""
+METADATA_CACHE_SIZE = 16
+"""
+    Maximum number of files cached open by the datasets of each process, the least recently used ones being evicted
+    (and closed when garbage collected, once no iterator or thread still reads them).
+"""
+DATASET_OPEN_FILES = 256
+"""
+    Suffix of the name of the array storing the scale of a quantized array (e.g. "features_scale" for "features").
+"""
+QUANTIZATION_SCALE_SUFFIX = '_scale'
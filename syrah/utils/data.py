@@ -16,43 +16,250 @@
     You should have received a copy of the GNU General Public License
     along with Syrah.  If not, see <https://www.gnu.org/licenses/>.
 """
-from typing import List, Tuple, Dict, Callable, Optional
+from typing import List, Tuple, Dict, Callable, Optional, Iterator
+from collections import OrderedDict
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor
 from numpy import ndarray
 from .. import File
+from .. import config
+from .._hl.files import check_access_hint
+from .quantization import QUANTIZATION_TYPES, dequantize_int8
+
+import os
+import sys
+import threading
+import numpy as np
 
 try:
-    from torch.utils.data.dataset import Dataset, ConcatDataset
+    import torch
+    from torch.utils.data import get_worker_info, default_collate
+    from torch.utils.data.dataset import Dataset, ConcatDataset, IterableDataset
 except ModuleNotFoundError:
     raise ModuleNotFoundError('Module torch not found, required to use the syrah.data module. Install pysyrah[all] '
                               'or pysyrah[torch].')
 
 
+"""
+    Whether tensor storages can be allocated in shared memory directly (private API of torch>=2.0)
+"""
+_HAS_TYPED_STORAGE = hasattr(torch.Tensor, '_typed_storage')
+
+"""
+    Files opened by the datasets of the current process, keyed by path and opening options, the least recently used
+    first
+"""
+_OPEN_FILES: 'OrderedDict[Tuple[str, bool, Optional[str]], File]' = OrderedDict()
+_OPEN_FILES_LOCK = threading.Lock()
+
+
+def _reset_open_files():
+    """
+    Forget the files opened by the parent process, each data loader worker opens its own.
+    :return:
+    """
+    global _OPEN_FILES_LOCK
+    _OPEN_FILES_LOCK = threading.Lock()
+    _OPEN_FILES.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_open_files)
+
+
+def _open_file(file_path: str, use_mmap: bool = False, access_hint: Optional[str] = None) -> File:
+    """
+    Get the file opened for reading at the given path, opening it if necessary.
+    At most config.DATASET_OPEN_FILES files are cached, so that datasets made of many files only keep the files being
+    read open. Evicted files are not closed explicitly, as they may still be read (e.g. by an iterator or a
+    prefetching thread), they are closed when garbage collected once they are no longer used.
+    :param file_path: path to the Syrah file
+    :param use_mmap: memory-map the file and return arrays as read-only views of the mapping
+    :param access_hint: expected read access pattern passed to the kernel ("random", "sequential" or None)
+    :return: file object
+    """
+    key = (file_path, use_mmap, access_hint)
+
+    with _OPEN_FILES_LOCK:
+        syr = _OPEN_FILES.get(key)
+        if syr is not None:
+            _OPEN_FILES.move_to_end(key)
+            return syr
+
+        syr = File(file_path, 'r', use_mmap=use_mmap, access_hint=access_hint)
+        _OPEN_FILES[key] = syr
+        while len(_OPEN_FILES) > config.DATASET_OPEN_FILES:
+            _OPEN_FILES.popitem(last=False)
+
+    return syr
+
+
+def collate_arrays(batch: List[Tuple[ndarray, ...]]) -> List[torch.Tensor]:
+    """
+    Collate the items of a batch by copying their arrays straight into one tensor per position, to be passed as
+    "collate_fn" argument of a DataLoader instead of the default function which converts each array to a tensor first.
+    In data loader workers, the tensors are allocated in shared memory so that they are sent without another copy.
+    Positions whose elements are not numpy arrays are collated with the default function.
+    :param batch: list of tuples of arrays, as returned by the datasets
+    :return: list of tensors, with one row per item
+    """
+    in_worker = get_worker_info() is not None
+    collated = []
+
+    for arrays in zip(*batch):
+        first_array = arrays[0]
+        if not isinstance(first_array, ndarray):
+            collated.append(default_collate(list(arrays)))
+            continue
+
+        dtype = torch.from_numpy(np.empty(0, dtype=first_array.dtype)).dtype
+        shape = (len(arrays),) + first_array.shape
+        if in_worker and _HAS_TYPED_STORAGE:
+            # allocated in shared memory directly, as done by the default function
+            storage = torch.empty(0, dtype=dtype)._typed_storage()._new_shared(len(arrays) * first_array.size)
+            out = torch.empty(0, dtype=dtype).new(storage).resize_(shape)
+        elif in_worker:
+            out = torch.empty(shape, dtype=dtype).share_memory_()
+        else:
+            out = torch.empty(shape, dtype=dtype)
+
+        np.stack(arrays, out=out.numpy())
+        collated.append(out)
+
+    return collated
+
+
+class _ItemProcessor:
+    """
+    Returns the processed arrays of an item as a tuple, the keys and processing functions being looked up once.
+    """
+    def __init__(self, keys: List[str], process_funcs: Dict[str, Callable],
+                 quantize: Optional[Dict[str, str]] = None):
+        """
+        Create a new item processor.
+        :param keys: list of keys to retrieve from the items
+        :param process_funcs: dictionary of functions to apply to each retrieved array based on its key
+        :param quantize: dictionary of quantization types of the quantized arrays based on their key
+        """
+        quantize = quantize or dict()
+        for key, quantization_type in quantize.items():
+            if quantization_type not in QUANTIZATION_TYPES:
+                raise ValueError(f'Quantization type {quantization_type} of key {key} is not supported. Supported '
+                                 f'types are: {", ".join(QUANTIZATION_TYPES)}')
+
+        self._args = (keys, process_funcs, quantize)
+        # interned, as the keys of the file metadata, so that the lookups of every item compare them by identity
+        keys = [sys.intern(key) for key in keys]
+
+        self.keys = keys
+        # a single key would be returned without a tuple
+        self.getter = itemgetter(*keys) if len(keys) > 1 else None
+        self.scale_keys = [(position, sys.intern(key + config.QUANTIZATION_SCALE_SUFFIX))
+                           for position, key in enumerate(keys) if key in quantize]
+        self.funcs = [(position, process_funcs[key]) for position, key in enumerate(keys) if key in process_funcs]
+        # names of the arrays to read, including the scales of the quantized arrays
+        self.array_names = self.keys + [scale_key for _, scale_key in self.scale_keys]
+
+    def __reduce__(self) -> tuple:
+        """
+        Recreate the item processor when unpickled (e.g. in data loader workers started with "spawn"), so that the keys
+        are interned again in the new process.
+        :return: class and arguments of the item processor
+        """
+        return _ItemProcessor, self._args
+
+    def __call__(self, item: Dict[str, ndarray]) -> Tuple[ndarray, ...]:
+        """
+        Apply the processing functions to the arrays of an item.
+        :param item: dictionary of (array name, array data) pairs
+        :return: tuple of arrays
+        """
+        arrays = self.getter(item) if self.getter is not None else tuple([item[key] for key in self.keys])
+
+        if not self.funcs and not self.scale_keys:
+            return arrays
+
+        arrays = list(arrays)
+        for position, scale_key in self.scale_keys:
+            arrays[position] = dequantize_int8(arrays[position], item[scale_key])
+        for position, func in self.funcs:
+            arrays[position] = func(arrays[position])
+
+        return tuple(arrays)
+
+
 class SyrahDataset(Dataset):
     """
     Represents a PyTorch Dataset using a Syrah file to store the data.
+    When read for several epochs with num_workers > 0, the DataLoader should be created with persistent_workers=True
+    so that the workers, the files they opened and their item cache are kept from one epoch to the next.
     """
-    def __init__(self, file_path: str, keys: List[str], process_funcs: Optional[Dict[str, Callable]] = None):
+    def __init__(self, file_path: str, keys: List[str], process_funcs: Optional[Dict[str, Callable]] = None,
+                 cache_bytes: int = 0, quantize: Optional[Dict[str, str]] = None, use_mmap: bool = False,
+                 access_hint: Optional[str] = None):
         """
         Create a new `Dataset` object.
         :param file_path: path to the Syrah file
         :param keys: list of keys to retrieve from the data
         :param process_funcs: dictionary of functions to apply to each retrieved array based on its key
+        :param cache_bytes: maximum size in bytes of the arrays kept in memory by each process to be returned again
+            without reading the file (0 to disable), the least recently used items being evicted
+        :param quantize: dictionary of quantization types ("int8") of the arrays stored quantized based on their key,
+            the arrays being converted back to float32 (before the processing functions) using the scale stored
+            next to them (see `syrah.utils.quantization.quantize_int8`)
+        :param use_mmap: memory-map the file and return the arrays as read-only views of the mapping instead of copies
+            (the processing functions must not modify them in place)
+        :param access_hint: expected read access pattern passed to the kernel when opening the file ("random" when the
+            items are shuffled to disable readahead, "sequential" for full scans or None)
         """
         self.file_path = file_path
         self.keys = keys
         self.process_funcs = process_funcs or dict()
+        self.cache_bytes = cache_bytes
+        self.quantize = quantize or dict()
+        self.use_mmap = use_mmap
+        check_access_hint(access_hint)
+        self.access_hint = access_hint
+        self._process_item = _ItemProcessor(keys, self.process_funcs, self.quantize)
 
-        self.syr = File(file_path, 'r')
-        self.len = self.syr.num_items()
+        self._cache: 'OrderedDict[int, Dict[str, ndarray]]' = OrderedDict()
+        self._cache_size = 0
+
+        with File(file_path, 'r') as syr:
+            self.len = syr.num_items()
+
+    @property
+    def syr(self) -> File:
+        """
+        Dataset file, opened on first access in each process.
+        """
+        return _open_file(self.file_path, self.use_mmap, self.access_hint)
+
+    @property
+    def _array_names(self) -> List[str]:
+        """
+        Names of the arrays to read, including the scales of the quantized arrays.
+        """
+        return self._process_item.array_names
+
+    def __getstate__(self) -> dict:
+        """
+        Get the state of the dataset to pickle, e.g. when starting data loader workers with "spawn".
+        The cached items of this process are not included, each worker starts with an empty cache.
+        :return: state of the dataset
+        """
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        state['_cache_size'] = 0
+
+        return state
 
     def worker_init_fn(self, worker_id: int = -1):
         """
-        Opens the dataset file.
-        Needs to be set as "worker_init_fn" argument when using a Dataloader with num_workers > 1.
+        Kept for compatibility, the file is now opened by each worker on first access so setting this method as
+        "worker_init_fn" argument of a Dataloader with num_workers > 1 is no longer needed.
         :param worker_id: id of the PyTorch data loader worker calling the method
         """
-        self.syr.open(self.file_path, 'r')
-        self.len = self.syr.num_items()
 
     def __getitem__(self, item: int) -> Tuple[ndarray, ...]:
         """
@@ -60,14 +267,64 @@ class SyrahDataset(Dataset):
         :param item: index of the item
         :return: tuple of arrays
         """
+        if self.cache_bytes > 0:
+            return self._process_item(self._get_items([item])[0])
 
-        processed_arrays = [
-            self.process_funcs[key](self.syr.get_array(item, key))
-            if key in self.process_funcs else self.syr.get_array(item, key)
-            for key in self.keys
-        ]
+        return self._process_item(self.syr.get_item(item, array_names=self._array_names))
+
+    def __getitems__(self, items: List[int]) -> List[Tuple[ndarray, ...]]:
+        """
+        Access several items at once, called by the PyTorch data loader (from version 2.0) to fetch a batch.
+        The arrays of all the items are read together, contiguous arrays being merged into a single read.
+        :param items: indices of the items
+        :return: list of tuples of arrays
+        """
+        if type(self).__getitem__ is not SyrahDataset.__getitem__:
+            # items of subclasses overriding __getitem__ (e.g. for preprocessing) are still built one by one
+            return [self[item] for item in items]
+
+        return [self._process_item(item) for item in self._get_items(items)]
 
-        return tuple(processed_arrays)
+    def _get_items(self, items: List[int]) -> List[Dict[str, ndarray]]:
+        """
+        Get the arrays of several items, from the cache if enabled or from the file.
+        Cached arrays are read-only and are not processed, the processing functions being applied on each access.
+        :param items: indices of the items
+        :return: list of dictionaries of (array name, array data) pairs
+        """
+        if self.cache_bytes <= 0:
+            return self.syr.get_items(items, self._array_names)
+
+        cached_items = [self._cache.get(item) for item in items]
+        missing_items = [item for item, cached_item in zip(items, cached_items) if cached_item is None]
+        read_items = iter(self.syr.get_items(missing_items, self._array_names) if missing_items else [])
+
+        # hits are marked as recently used before inserting the misses, which may still evict them (they are returned
+        # from the references kept above)
+        for item, cached_item in zip(items, cached_items):
+            if cached_item is not None and item in self._cache:
+                self._cache.move_to_end(item)
+
+        for position, item in enumerate(items):
+            if cached_items[position] is not None:
+                continue
+
+            # copied so that the arrays do not keep the whole buffer of a merged read in memory
+            cached_item = {key: array.copy() for key, array in next(read_items).items()}
+            for array in cached_item.values():
+                array.flags.writeable = False
+            cached_items[position] = cached_item
+
+            item_size = sum(array.nbytes for array in cached_item.values())
+            if item in self._cache or item_size > self.cache_bytes:
+                continue
+
+            self._cache[item] = cached_item
+            self._cache_size += item_size
+            while self._cache_size > self.cache_bytes:
+                self._cache_size -= sum(array.nbytes for array in self._cache.popitem(last=False)[1].values())
+
+        return cached_items
 
     def __len__(self) -> int:
         """
@@ -90,9 +347,178 @@ class SyrahConcatDataset(ConcatDataset):
 
     def worker_init_fn(self, worker_id: int = -1):
         """
-        Open each of the dataset file.
-        Needs to be set as "worker_init_fn" argument when using a Dataloader with num_workers > 1.
+        Kept for compatibility, the files are now opened by each worker on first access so setting this method as
+        "worker_init_fn" argument of a Dataloader with num_workers > 1 is no longer needed.
         :param worker_id: id of the PyTorch data loader worker calling the method
         """
         for dataset in self.datasets:
             dataset.worker_init_fn(worker_id)
+
+    def __getitems__(self, items: List[int]) -> List[Tuple[ndarray, ...]]:
+        """
+        Access several items at once, called by the PyTorch data loader (from version 2.0) to fetch a batch.
+        The datasets of all the items are found with a single search and the items of each dataset are read together.
+        :param items: indices of the items
+        :return: list of tuples of arrays
+        """
+        indices = np.asarray(items, dtype=np.int64)
+        if len(indices) > 0 and (indices.min() < -len(self) or indices.max() >= len(self)):
+            raise IndexError(f'Items out of range for dataset of length {len(self)}.')
+        indices[indices < 0] += len(self)
+
+        cumulative_sizes = np.asarray(self.cumulative_sizes, dtype=np.int64)
+        dataset_idxs = np.searchsorted(cumulative_sizes, indices, side='right')
+        sample_idxs = indices - np.concatenate([[0], cumulative_sizes[:-1]])[dataset_idxs]
+
+        batch: List[Optional[Tuple[ndarray, ...]]] = [None] * len(indices)
+        for dataset_idx in np.unique(dataset_idxs):
+            positions = np.flatnonzero(dataset_idxs == dataset_idx)
+            dataset = self.datasets[dataset_idx]
+            dataset_items = sample_idxs[positions].tolist()
+
+            if hasattr(dataset, '__getitems__'):
+                dataset_batch = dataset.__getitems__(dataset_items)
+            else:
+                dataset_batch = [dataset[item] for item in dataset_items]
+
+            for position, item in zip(positions.tolist(), dataset_batch):
+                batch[position] = item
+
+        return batch
+
+
+class SyrahBlockIterableDataset(IterableDataset):
+    """
+    Represents a PyTorch IterableDataset reading a Syrah file by blocks of consecutive items.
+    The order of the blocks is shuffled and the items of several blocks fetched together are shuffled again,
+    so that the file is mostly read sequentially while the items are still returned in a random order.
+    """
+    def __init__(self, file_path: str, keys: List[str], block_size: int = 64, fetch_factor: int = 16,
+                 shuffle: bool = True, process_funcs: Optional[Dict[str, Callable]] = None, prefetch: bool = False,
+                 quantize: Optional[Dict[str, str]] = None, use_mmap: bool = False, access_hint: Optional[str] = None):
+        """
+        Create a new `IterableDataset` object.
+        :param file_path: path to the Syrah file
+        :param keys: list of keys to retrieve from the data
+        :param block_size: number of consecutive items in a block
+        :param fetch_factor: number of blocks read together and whose items are shuffled together
+        :param shuffle: shuffle the blocks and the items of each fetch at every iteration
+        :param process_funcs: dictionary of functions to apply to each retrieved array based on its key
+        :param prefetch: read the next blocks in a background thread while the items of the current ones are returned
+        :param quantize: dictionary of quantization types ("int8") of the arrays stored quantized based on their key
+        :param use_mmap: memory-map the file and return the arrays as read-only views of the mapping instead of copies
+            (the processing functions must not modify them in place)
+        :param access_hint: expected read access pattern passed to the kernel when opening the file ("sequential" to
+            read large blocks ahead, "random" to disable readahead when the blocks are small, or None)
+        """
+        if block_size < 1 or fetch_factor < 1:
+            raise ValueError(f'Expected block_size and fetch_factor to be positive, got {block_size} and '
+                             f'{fetch_factor}.')
+
+        self.file_path = file_path
+        self.keys = keys
+        self.block_size = block_size
+        self.fetch_factor = fetch_factor
+        self.shuffle = shuffle
+        self.process_funcs = process_funcs or dict()
+        self.prefetch = prefetch
+        self.quantize = quantize or dict()
+        self.use_mmap = use_mmap
+        check_access_hint(access_hint)
+        self.access_hint = access_hint
+        self._process_item = _ItemProcessor(keys, self.process_funcs, self.quantize)
+
+        with File(file_path, 'r') as syr:
+            self.len = syr.num_items()
+
+    @property
+    def syr(self) -> File:
+        """
+        Dataset file, opened on first access in each process.
+        """
+        return _open_file(self.file_path, self.use_mmap, self.access_hint)
+
+    @property
+    def _array_names(self) -> List[str]:
+        """
+        Names of the arrays to read, including the scales of the quantized arrays.
+        """
+        return self._process_item.array_names
+
+    def worker_init_fn(self, worker_id: int = -1):
+        """
+        Kept for compatibility, the file is now opened by each worker on first access so setting this method as
+        "worker_init_fn" argument of a Dataloader with num_workers > 1 is no longer needed.
+        :param worker_id: id of the PyTorch data loader worker calling the method
+        """
+
+    def __iter__(self) -> Iterator[Tuple[ndarray, ...]]:
+        """
+        Iterate over the items of the dataset, the blocks being split between the data loader workers.
+        :return: iterator of tuples of arrays
+        """
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            # same seed in every worker for a given epoch, so that they all draw the same order of blocks
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            seed = worker_info.seed - worker_info.id
+
+        rng = np.random.default_rng(seed)
+        block_starts = np.arange(0, self.len, self.block_size)
+        if self.shuffle:
+            block_starts = rng.permutation(block_starts)
+        block_starts = block_starts[worker_id::num_workers]
+
+        fetches = [
+            np.concatenate([
+                np.arange(block_start, min(block_start + self.block_size, self.len))
+                for block_start in np.sort(block_starts[fetch_start:fetch_start + self.fetch_factor])
+            ])
+            for fetch_start in range(0, len(block_starts), self.fetch_factor)
+        ]
+        syr = self.syr
+
+        if not self.prefetch:
+            fetched_items = (syr.get_items(indices, self._array_names) for indices in fetches)
+        else:
+            fetched_items = self._prefetch_items(syr, fetches)
+
+        for items in fetched_items:
+            order = rng.permutation(len(items)) if self.shuffle else range(len(items))
+
+            for position in order:
+                yield self._process_item(items[position])
+
+    def _prefetch_items(self, syr: File, fetches: List[ndarray]) -> Iterator[List[Dict[str, ndarray]]]:
+        """
+        Read the items of each fetch in a background thread, the next fetch being read while the current one is used.
+        :param syr: dataset file
+        :param fetches: indices of the items of each fetch
+        :return: iterator of lists of dictionaries of (array name, array data) pairs, one list per fetch
+        """
+        if len(fetches) == 0:
+            return
+
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        try:
+            future = executor.submit(syr.get_items, fetches[0], self._array_names)
+
+            for next_indices in fetches[1:]:
+                items = future.result()
+                future = executor.submit(syr.get_items, next_indices, self._array_names)
+                yield items
+
+            yield future.result()
+        finally:
+            executor.shutdown()
+
+    def __len__(self) -> int:
+        """
+        Returns the length of the dataset.
+        :return: length of the dataset
+        """
+        return self.len
@@ -0,0 +1,72 @@
+"""
+    Pool of reusable byte buffers.
+
+    This file is part of Syrah.
+
+    Syrah is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Syrah is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Syrah.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from typing import Dict, Deque
+from collections import deque
+
+import threading
+
+
+"""
+    Maximum number of released buffers kept per size bucket and per thread
+"""
+MAX_BUFFERS_PER_BUCKET = 8
+
+_local = threading.local()
+
+
+def _get_buckets() -> Dict[int, Deque[bytearray]]:
+    """
+    Get the buffer buckets of the calling thread.
+    :return: dictionary of (buffer size, released buffers) pairs
+    """
+    buckets = getattr(_local, 'buckets', None)
+
+    if buckets is None:
+        buckets = _local.buckets = dict()
+
+    return buckets
+
+
+def get_buffer(size: int) -> bytearray:
+    """
+    Get a buffer of at least the given size, reusing a released buffer if possible.
+    The buffer size is rounded up to the next power of two.
+    :param size: minimum size of the buffer in bytes
+    :return: a buffer
+    """
+    bucket_size = 1 << max(int(size) - 1, 0).bit_length()
+    bucket = _get_buckets().get(bucket_size)
+
+    if bucket:
+        return bucket.pop()
+
+    return bytearray(bucket_size)
+
+
+def release_buffer(buffer: bytearray):
+    """
+    Give a buffer obtained with `get_buffer` back to the pool of the calling thread.
+    The buffer must not be used after being released.
+    :param buffer: buffer to release
+    :return:
+    """
+    bucket = _get_buckets().setdefault(len(buffer), deque())
+
+    if len(bucket) < MAX_BUFFERS_PER_BUCKET:
+        bucket.append(buffer)
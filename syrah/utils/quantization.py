@@ -0,0 +1,52 @@
+"""
+    Quantization of floating point arrays to reduce the size of the files and of the reads.
+
+    This file is part of Syrah.
+
+    Syrah is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    Syrah is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with Syrah.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from typing import Tuple, Optional
+from numpy import ndarray
+
+import numpy as np
+
+
+"""
+    Supported quantization types.
+"""
+QUANTIZATION_TYPES = ('int8',)
+
+
+def quantize_int8(array: ndarray) -> Tuple[ndarray, ndarray]:
+    """
+    Quantize a floating point array to int8 with a symmetric per-array scale.
+    :param array: array to quantize
+    :return: quantized array and scale (float32 array of length one) to store next to it
+    """
+    max_abs = np.abs(array).max() if array.size > 0 else 0
+    scale = np.float32(max_abs / 127) if max_abs > 0 else np.float32(1)
+    quantized_array = np.clip(np.rint(array / scale), -127, 127).astype(np.int8)
+
+    return quantized_array, np.array([scale], dtype=np.float32)
+
+
+def dequantize_int8(array: ndarray, scale: ndarray, out: Optional[ndarray] = None) -> ndarray:
+    """
+    Convert an int8 array quantized with `quantize_int8` back to float32.
+    :param array: quantized array
+    :param scale: scale returned by `quantize_int8`
+    :param out: existing float32 array to write the result into instead of a new one
+    :return: a float32 array (`out` if specified)
+    """
+    return np.multiply(array, scale, out=out, dtype=np.float32)
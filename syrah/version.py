@@ -16,10 +16,20 @@
     You should have received a copy of the GNU General Public License
     along with Syrah.  If not, see <https://www.gnu.org/licenses/>.
 """
-from collections import namedtuple
+from operator import itemgetter
 
-_SYRAH_VERSION = namedtuple("_SYRAH_VERSION", "major minor bugfix")
 
-version_tuple = _SYRAH_VERSION(0, 2, 0)
+class _SYRAH_VERSION(tuple):
+    """
+    Version number as a (major, minor, bugfix) tuple, lighter to create on import than a namedtuple.
+    """
+    __slots__ = ()
 
-version = "{0.major:d}.{0.minor:d}.{0.bugfix:d}".format(version_tuple)
+    major = property(itemgetter(0))
+    minor = property(itemgetter(1))
+    bugfix = property(itemgetter(2))
+
+
+version = "0.2.0"
+
+version_tuple = _SYRAH_VERSION(map(int, version.split(".")))
@@ -17,11 +17,16 @@
     along with Syrah.  If not, see <https://www.gnu.org/licenses/>.
 """
 import unittest
-from syrah import File
-from syrah.utils.data import SyrahDataset, SyrahConcatDataset
+from syrah import File, config
+from syrah.utils.data import SyrahDataset, SyrahConcatDataset, SyrahBlockIterableDataset, collate_arrays
+from syrah.utils.quantization import quantize_int8
+from syrah.utils import data
 import numpy as np
+import torch
 from torch.utils.data import DataLoader, ConcatDataset
 import pickle
+import random
+import sys
 
 
 BASE_PATH = '/tmp/syrah_test_data'
@@ -40,7 +45,12 @@ def create_test_data(base_path, num_items, max_items):
     data_dict = dict()
     fp_syr = None
     i_syr = 0
-    i_local = 0
+    rng = np.random.default_rng()
+
+    labels = rng.integers(0, NUM_CLASSES, size=(num_items, 1), dtype=np.int32)
+    fixed_len_arrays = rng.random((num_items, FIXED_LEN), dtype=np.float32)
+    var_lens = rng.integers(MIN_VAR_LEN, MAX_VAR_LEN, size=num_items)
+    var_len_arrays = np.split(rng.integers(0, MAX_VAL, size=var_lens.sum(), dtype=np.int32), np.cumsum(var_lens)[:-1])
 
     for i in range(num_items):
         if i % max_items == 0:
@@ -48,31 +58,32 @@ def create_test_data(base_path, num_items, max_items):
                 fp_syr.close()
             fp_syr = File(base_path + '_' + str(i_syr) + '.syr', 'w')
             i_syr += 1
-            i_local = 0
-
-        label = np.random.randint(0, NUM_CLASSES, size=1, dtype=np.int32)
-        fixed_len_array = np.random.random(FIXED_LEN).astype(np.float32)
-        var_len_array = np.random.randint(0, MAX_VAL, size=np.random.randint(MIN_VAR_LEN, MAX_VAR_LEN), dtype=np.int32)
 
         fp_syr.add_item({
             'idx': np.array([i], dtype=np.int32),
-            'label': label,
-            'fixed_len_array': fixed_len_array,
-            'var_len_array': var_len_array
+            'label': labels[i],
+            'fixed_len_array': fixed_len_arrays[i],
+            'var_len_array': var_len_arrays[i]
         })
         pickled_item = dict()
-        pickled_item['label'] = label
-        pickled_item['fixed_len_array'] = fixed_len_array
-        pickled_item['var_len_array'] = var_len_array
+        pickled_item['label'] = labels[i]
+        pickled_item['fixed_len_array'] = fixed_len_arrays[i]
+        pickled_item['var_len_array'] = var_len_arrays[i]
 
         data_dict[str(i)] = pickled_item
-        i_local += 1
 
     fp_syr.close()
 
     return data_dict
 
 
+def seed_worker(worker_id):
+    # the PyTorch seed differs between workers, numpy and random are seeded from it so that they differ as well
+    worker_seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
 data_dict = create_test_data(BASE_PATH, NUM_ITEMS, MAX_ITEMS)
 
 
@@ -80,13 +91,151 @@ class TestSingleDataset(unittest.TestCase):
     def test_sequential_item_read(self):
         syr_dataset = SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'label', 'fixed_len_array', 'var_len_array'])
         syr_dataloader = DataLoader(syr_dataset, shuffle=False, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS,
-                                    worker_init_fn=syr_dataset.worker_init_fn)
+                                    persistent_workers=True, worker_init_fn=seed_worker)
+
+        # the workers and the files they opened are reused for the second epoch
+        for _ in range(2):
+            for idx, label, fixed_len_array, var_len_array in syr_dataloader:
+                pickled_item = data_dict[str(idx[0].numpy()[0])]
+                assert np.all(label.numpy() == pickled_item['label'])
+                assert np.all(fixed_len_array.numpy() == pickled_item['fixed_len_array'])
+                assert np.all(var_len_array.numpy() == pickled_item['var_len_array'])
+
+    def test_mmap_item_read(self):
+        syr_dataset = SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'fixed_len_array', 'var_len_array'],
+                                   use_mmap=True)
+        assert syr_dataset.syr is not SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx']).syr
+
+        for i in np.random.permutation(MAX_ITEMS)[:10]:
+            idx, fixed_len_array, var_len_array = syr_dataset[i]
+            assert idx[0] == i
+            assert not fixed_len_array.flags.writeable
+            assert np.all(fixed_len_array == data_dict[str(i)]['fixed_len_array'])
+            assert np.all(var_len_array == data_dict[str(i)]['var_len_array'])
+
+        syr_dataset = SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'fixed_len_array'], use_mmap=True)
+        syr_dataloader = DataLoader(syr_dataset, shuffle=True, batch_size=8, num_workers=2, worker_init_fn=seed_worker)
+        for idx, fixed_len_array in syr_dataloader:
+            for i, item_array in zip(idx.numpy()[:, 0], fixed_len_array.numpy()):
+                assert np.all(item_array == data_dict[str(i)]['fixed_len_array'])
+
+    def test_access_hint_item_read(self):
+        syr_dataset = SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'label'], access_hint='random')
+        syr_dataloader = DataLoader(syr_dataset, shuffle=True, batch_size=8, num_workers=2, worker_init_fn=seed_worker)
+
+        for idx, label in syr_dataloader:
+            for i, item_label in zip(idx.numpy()[:, 0], label.numpy()):
+                assert np.all(item_label == data_dict[str(i)]['label'])
+
+        with self.assertRaises(ValueError):
+            SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx'], access_hint='shuffled')
+
+    def test_collated_item_read(self):
+        syr_dataset = SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'label', 'fixed_len_array'],
+                                   process_funcs={'label': lambda array: int(array[0])})
+        has_typed_storage = data._HAS_TYPED_STORAGE
+
+        try:
+            # with and without the private shared storage API (missing before torch 2.0)
+            for num_workers, typed_storage in ((0, has_typed_storage), (2, has_typed_storage), (2, False)):
+                data._HAS_TYPED_STORAGE = typed_storage
+                syr_dataloader = DataLoader(syr_dataset, shuffle=True, batch_size=8, num_workers=num_workers,
+                                            collate_fn=collate_arrays, worker_init_fn=seed_worker)
+
+                for idx, label, fixed_len_array in syr_dataloader:
+                    assert fixed_len_array.dtype == torch.float32 and fixed_len_array.shape[1:] == (FIXED_LEN,)
+                    for i, item_label, item_array in zip(idx.numpy()[:, 0], label.numpy(), fixed_len_array.numpy()):
+                        assert item_label == data_dict[str(i)]['label'][0]
+                        assert np.all(item_array == data_dict[str(i)]['fixed_len_array'])
+        finally:
+            data._HAS_TYPED_STORAGE = has_typed_storage
+
+    def test_batched_item_read(self):
+        syr_dataset = SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'var_len_array'],
+                                   process_funcs={'var_len_array': lambda array: array.sum(keepdims=True)})
+        item_idxs = list(np.random.permutation(MAX_ITEMS)[:32])
+
+        for item, batch_item in zip(map(syr_dataset.__getitem__, item_idxs), syr_dataset.__getitems__(item_idxs)):
+            assert len(item) == len(batch_item)
+            for array, batch_array in zip(item, batch_item):
+                assert np.all(array == batch_array)
+
+    def test_subclass_item_read(self):
+        class CustomSyrahDataset(SyrahDataset):
+            def __getitem__(self, item):
+                idx, label = super().__getitem__(item)
+                return idx, label + NUM_CLASSES
+
+        syr_dataset = CustomSyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'label'])
+        syr_dataloader = DataLoader(syr_dataset, batch_size=8)
+
+        for idx, label in syr_dataloader:
+            for i, item_label in zip(idx.numpy()[:, 0], label.numpy()):
+                assert np.all(item_label == data_dict[str(i)]['label'] + NUM_CLASSES)
+
+    def test_pickled_item_read(self):
+        syr_dataset = SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'label'])
+        syr_dataset[0]
+
+        # as done when starting workers with "spawn", the dataset does not hold the file opened in this process
+        unpickled_dataset = pickle.loads(pickle.dumps(syr_dataset))
+        assert 'syr' not in vars(unpickled_dataset)
+        # the keys are interned again in the new process
+        assert all(key is sys.intern(key) for key in unpickled_dataset._array_names)
+        for i in np.random.permutation(MAX_ITEMS)[:10]:
+            idx, label = unpickled_dataset[i]
+            assert idx[0] == i
+            assert np.all(label == data_dict[str(i)]['label'])
 
-        for idx, label, fixed_len_array, var_len_array in syr_dataloader:
-            pickled_item = data_dict[str(idx[0].numpy()[0])]
-            assert np.all(label.numpy() == pickled_item['label'])
-            assert np.all(fixed_len_array.numpy() == pickled_item['fixed_len_array'])
-            assert np.all(var_len_array.numpy() == pickled_item['var_len_array'])
+    def test_cached_item_read(self):
+        item_size = 2 * np.dtype(np.int32).itemsize
+        syr_dataset = SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'label'], cache_bytes=10 * item_size)
+        item_idxs = list(np.random.permutation(MAX_ITEMS)[:20])
+
+        for _ in range(2):
+            for idx, label in syr_dataset.__getitems__(item_idxs[:5]) + [syr_dataset[i] for i in item_idxs]:
+                assert np.all(label == data_dict[str(idx[0])]['label'])
+
+        # only the last items read are kept, as read-only arrays returned again on the next access
+        assert list(syr_dataset._cache.keys()) == item_idxs[-10:]
+        assert syr_dataset._cache_size == 10 * item_size
+        assert syr_dataset[item_idxs[-1]][1] is syr_dataset[item_idxs[-1]][1]
+        assert not syr_dataset[item_idxs[-1]][1].flags.writeable
+
+        # the cache is not sent to the workers
+        assert len(pickle.loads(pickle.dumps(syr_dataset))._cache) == 0
+
+    def test_cached_item_eviction(self):
+        # room for a single item: the miss of a batch evicts its hit
+        syr_dataset = SyrahDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'label'],
+                                   cache_bytes=2 * np.dtype(np.int32).itemsize)
+        syr_dataset[1]
+
+        for i, (idx, label) in zip([0, 1], syr_dataset.__getitems__([0, 1])):
+            assert idx[0] == i
+            assert np.all(label == data_dict[str(i)]['label'])
+        assert list(syr_dataset._cache.keys()) == [0]
+
+    def test_quantized_item_read(self):
+        file_path = BASE_PATH + '_quantized' + '.syr'
+        with File(file_path, 'w') as syr:
+            for i in range(MAX_ITEMS):
+                quantized_array, scale = quantize_int8(data_dict[str(i)]['fixed_len_array'])
+                syr.add_item({'idx': np.array([i], dtype=np.int32), 'fixed_len_array': quantized_array,
+                              'fixed_len_array' + config.QUANTIZATION_SCALE_SUFFIX: scale})
+
+        syr_dataset = SyrahDataset(file_path, keys=['idx', 'fixed_len_array'], quantize={'fixed_len_array': 'int8'})
+        syr_dataloader = DataLoader(syr_dataset, shuffle=True, batch_size=8, num_workers=2, worker_init_fn=seed_worker)
+
+        for idx, fixed_len_array in syr_dataloader:
+            assert fixed_len_array.dtype == torch.float32
+            for i, item_array in zip(idx.numpy()[:, 0], fixed_len_array.numpy()):
+                pickled_array = data_dict[str(i)]['fixed_len_array']
+                # rounding error of at most half a quantization step
+                assert np.all(np.abs(item_array - pickled_array) <= np.abs(pickled_array).max() / 254 + 1e-6)
+
+        with self.assertRaises(ValueError):
+            SyrahDataset(file_path, keys=['fixed_len_array'], quantize={'fixed_len_array': 'bf16'})
 
 
 class TestConcatDataset(unittest.TestCase):
@@ -95,13 +244,76 @@ class TestConcatDataset(unittest.TestCase):
         syr_dataset_1 = SyrahDataset(BASE_PATH + '_1' + '.syr', keys=['idx', 'label', 'fixed_len_array', 'var_len_array'])
         syr_dataset = SyrahConcatDataset([syr_dataset_0, syr_dataset_1])
         syr_dataloader = DataLoader(syr_dataset, shuffle=False, batch_size=BATCH_SIZE, num_workers=NUM_WORKERS,
-                                    worker_init_fn=syr_dataset.worker_init_fn)
+                                    persistent_workers=True, worker_init_fn=seed_worker)
+
+        # the workers and the files they opened are reused for the second epoch
+        for _ in range(2):
+            for idx, label, fixed_len_array, var_len_array in syr_dataloader:
+                pickled_item = data_dict[str(idx[0].numpy()[0])]
+                assert np.all(label.numpy() == pickled_item['label'])
+                assert np.all(fixed_len_array.numpy() == pickled_item['fixed_len_array'])
+                assert np.all(var_len_array.numpy() == pickled_item['var_len_array'])
+
+    def test_batched_item_read(self):
+        syr_dataset = SyrahConcatDataset([
+            SyrahDataset(BASE_PATH + '_' + str(i_syr) + '.syr', keys=['idx', 'label']) for i_syr in range(2)
+        ])
+        item_idxs = list(np.random.permutation(NUM_ITEMS)[:64]) + [-1, 0]
+
+        batch = syr_dataset.__getitems__(item_idxs)
+        assert len(batch) == len(item_idxs)
+        for i, (idx, label) in zip(item_idxs, batch):
+            assert idx[0] == i % NUM_ITEMS
+            assert np.all(label == data_dict[str(i % NUM_ITEMS)]['label'])
+
+        with self.assertRaises(IndexError):
+            syr_dataset.__getitems__([NUM_ITEMS])
+
+    def test_open_files_limit(self):
+        syr_dataset = SyrahConcatDataset([
+            SyrahDataset(BASE_PATH + '_' + str(i_syr) + '.syr', keys=['idx', 'var_len_array']) for i_syr in range(2)
+        ])
+        dataset_open_files = config.DATASET_OPEN_FILES
+        config.DATASET_OPEN_FILES = 1
+
+        try:
+            # alternating between the files, which are reopened in each worker as only one can be kept open
+            item_idxs = np.stack([np.arange(MAX_ITEMS), np.arange(MAX_ITEMS) + MAX_ITEMS], axis=1).reshape(-1)
+            syr_dataloader = DataLoader(syr_dataset, sampler=item_idxs[:200], batch_size=BATCH_SIZE, num_workers=2,
+                                        worker_init_fn=seed_worker)
+
+            for i, (idx, var_len_array) in zip(item_idxs, syr_dataloader):
+                assert idx[0].numpy()[0] == i
+                assert np.all(var_len_array.numpy() == data_dict[str(i)]['var_len_array'])
+
+            # a file evicted while still in use (e.g. by a block iterator) can still be read
+            data._OPEN_FILES.clear()
+            syr_file = syr_dataset.datasets[0].syr
+            syr_dataset.datasets[1].syr
+            assert syr_file is not syr_dataset.datasets[0].syr
+            assert syr_file.get_array(0, 'idx')[0] == 0
+        finally:
+            config.DATASET_OPEN_FILES = dataset_open_files
+
+
+class TestBlockDataset(unittest.TestCase):
+    def test_shuffled_item_read(self):
+        for num_workers, prefetch in ((0, False), (2, False), (0, True), (2, True)):
+            syr_dataset = SyrahBlockIterableDataset(BASE_PATH + '_0' + '.syr', keys=['idx', 'label', 'var_len_array'],
+                                                    block_size=16, fetch_factor=4, prefetch=prefetch)
+            syr_dataloader = DataLoader(syr_dataset, batch_size=BATCH_SIZE, num_workers=num_workers,
+                                        worker_init_fn=seed_worker)
+            idxs = []
+
+            for idx, label, var_len_array in syr_dataloader:
+                pickled_item = data_dict[str(idx[0].numpy()[0])]
+                assert np.all(label.numpy() == pickled_item['label'])
+                assert np.all(var_len_array.numpy() == pickled_item['var_len_array'])
+                idxs.append(idx[0].numpy()[0])
 
-        for idx, label, fixed_len_array, var_len_array in syr_dataloader:
-            pickled_item = data_dict[str(idx[0].numpy()[0])]
-            assert np.all(label.numpy() == pickled_item['label'])
-            assert np.all(fixed_len_array.numpy() == pickled_item['fixed_len_array'])
-            assert np.all(var_len_array.numpy() == pickled_item['var_len_array'])
+            # every item is read exactly once, not in the order of the file
+            assert sorted(idxs) == list(range(MAX_ITEMS))
+            assert idxs != sorted(idxs)
 
 
 if __name__ == '__main__':
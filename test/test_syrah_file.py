@@ -17,8 +17,10 @@
     along with Syrah.  If not, see <https://www.gnu.org/licenses/>.
 """
 import unittest
+import os
 from typing import Dict
-from syrah import File
+from syrah import File, config
+from syrah._hl.metadata import MetadataWriter
 import numpy as np
 from numpy import ndarray
 from multiprocessing import Pool
@@ -26,27 +28,24 @@ from multiprocessing import Pool
 
 def create_test_data(num_items, num_classes, fixed_len, max_val, min_var_len, max_var_len):
     data_dict = dict()
+    rng = np.random.default_rng()
+
+    labels = rng.integers(0, num_classes, size=(num_items, 1), dtype=np.int32)
+    fixed_len_arrays = rng.random((num_items, fixed_len), dtype=np.float32)
+    var_lens = rng.integers(min_var_len, max_var_len, size=num_items)
+    var_len_arrays = np.split(rng.integers(0, max_val, size=var_lens.sum(), dtype=np.int32), np.cumsum(var_lens)[:-1])
 
     with File(syr_path, 'w') as syr:
         for i in range(num_items):
-            label = np.random.randint(0, num_classes, size=1, dtype=np.int32)
-            fixed_len_array = np.random.random(fixed_len).astype(np.float32)
-            var_len_array = np.random.randint(0, max_val,
-                                              size=np.random.randint(min_var_len, max_var_len),
-                                              dtype=np.int32)
-            syr.add_item({
-                'label': label,
-                'fixed_len_array': fixed_len_array,
-                'var_len_array': var_len_array
-                })
-
-            item = dict()
-            item['label'] = label
-            item['fixed_len_array'] = fixed_len_array
-            item['var_len_array'] = var_len_array
+            item = {
+                'label': labels[i],
+                'fixed_len_array': fixed_len_arrays[i],
+                'var_len_array': var_len_arrays[i]
+                }
+            syr.add_item(item)
 
             data_dict[i] = item
-            
+
     return data_dict
 
 
@@ -63,6 +62,14 @@ max_var_len = 1_000
 data_dict = create_test_data(num_items, num_classes, fixed_len, max_val, min_var_len, max_var_len)
 
 syr = File(syr_path, 'r')
+syr_mmap = File(syr_path, 'r', use_mmap=True)
+syr_prefetch = File(syr_path, 'r', prefetch=True)
+
+
+def init_worker(file_path):
+    global syr
+    # new file object in each worker instead of the one inherited from the parent process
+    syr = File(file_path, 'r')
 
 
 def assert_item_read(i):
@@ -105,31 +112,325 @@ class TestSingleMethods(unittest.TestCase):
         for i in item_idxs:
             assert_array_read(i)
 
+    def test_array_read_into(self):
+        item_idxs = np.random.permutation(num_items)[:100]
+
+        for syr_file in (syr, syr_mmap):
+            stack = np.empty((len(item_idxs), fixed_len), dtype=np.float32)
+            for row, i in zip(stack, item_idxs):
+                assert syr_file.get_array(i, 'fixed_len_array', out=row) is row
+            assert np.all(stack == np.stack([data_dict[i]['fixed_len_array'] for i in item_idxs]))
+
+        with self.assertRaises(TypeError):
+            syr.get_array(0, 'fixed_len_array', out=np.empty(fixed_len, dtype=np.float64))
+        with self.assertRaises(ValueError):
+            syr.get_array(0, 'fixed_len_array', out=np.empty(fixed_len + 1, dtype=np.float32))
+
+    def test_stack_read(self):
+        for item_idxs in (np.arange(num_items), np.random.permutation(num_items)):
+            for key in ('label', 'fixed_len_array'):
+                stack = syr.get_stack(item_idxs, key)
+                assert np.all(stack == np.stack([data_dict[i][key] for i in item_idxs]))
+
+        with self.assertRaises(ValueError):
+            syr.get_stack(range(num_items), 'var_len_array')
+
+    def test_prefetch_item_read(self):
+        for item_idxs in (range(num_items), np.random.permutation(num_items)):
+            for i in item_idxs:
+                for key, value in syr_prefetch.get_item(i).items():
+                    assert np.all(data_dict[i][key] == value)
+
+    def test_partial_item_read(self):
+        for syr_file in (syr, syr_prefetch):
+            for i in np.random.permutation(num_items)[:100]:
+                syr_item = syr_file.get_item(i, array_names=['var_len_array', 'label'])
+                assert list(syr_item.keys()) == ['var_len_array', 'label']
+                for key, value in syr_item.items():
+                    assert np.all(data_dict[i][key] == value)
+
+        with self.assertRaises(KeyError):
+            syr.get_item(0, array_names=['missing_array'])
+        with self.assertRaises(ValueError):
+            syr.get_item(0, as_tuple=True, array_names=['label'])
+
+    def test_tuple_item_read(self):
+        for i in np.random.permutation(num_items):
+            syr_item = syr.get_item(i, as_tuple=True)
+            assert np.all(syr_item.label == data_dict[i]['label'])
+            assert np.all(syr_item.fixed_len_array == data_dict[i]['fixed_len_array'])
+            assert np.all(syr_item.var_len_array == data_dict[i]['var_len_array'])
+
+    def test_batch_item_read(self):
+        item_idxs = np.random.permutation(num_items)
+
+        for batch_idxs in np.array_split(item_idxs, 10) + [[5, 5, 7, 3]]:
+            for i, syr_item in zip(batch_idxs, syr.get_items(batch_idxs)):
+                for key, value in syr_item.items():
+                    assert np.all(data_dict[i][key] == value)
+
+        for i, syr_item in zip(item_idxs[:10], syr.get_items(item_idxs[:10], ['var_len_array'])):
+            assert syr_item.keys() == {'var_len_array'}
+            assert np.all(data_dict[i]['var_len_array'] == syr_item['var_len_array'])
+
+        with self.assertRaises(KeyError):
+            syr.get_items([0], ['missing_array'])
+
+    def test_batch_read(self):
+        item_idxs = np.random.permutation(num_items)
+
+        for batch_idxs in np.array_split(item_idxs, 10) + [[5, 5, 7, 3], []]:
+            batch = syr.get_batch(batch_idxs, ['label', 'fixed_len_array'])
+
+            for key, stack in batch.items():
+                assert stack.shape[0] == len(batch_idxs)
+                for i, array in zip(batch_idxs, stack):
+                    assert np.all(data_dict[i][key] == array)
+
+        with self.assertRaises(ValueError):
+            syr.get_batch([0, 1], ['var_len_array'])
+
+    def test_threaded_batch_read(self):
+        item_idxs = np.random.permutation(num_items)
+
+        with File(syr_path, 'r', io_threads=4) as syr_threaded:
+            for batch_idxs in np.array_split(item_idxs, 10):
+                # evict the file from the page cache so that some reads are handed over to the threads
+                os.posix_fadvise(syr_threaded._fp.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+                for i, syr_item in zip(batch_idxs, syr_threaded.get_items(batch_idxs)):
+                    for key, value in syr_item.items():
+                        assert np.all(data_dict[i][key] == value)
+
+    def test_metadata_bind(self):
+        get_offset = syr._metadata.bind('var_len_array', 'offset')
+        get_dtype = syr._metadata.bind('var_len_array', 'dtype')
+
+        for i in np.random.permutation(num_items)[:100]:
+            assert get_offset(i) == syr._metadata.get(i, 'var_len_array', 'offset')
+            assert get_dtype(i) == 'int32'
+
+    def test_num_items(self):
+        File.clear_metadata_cache()
+
+        with File(syr_path, 'r') as syr_lazy:
+            assert syr_lazy.num_items() == num_items
+            # counting items does not deserialize the metadata
+            assert syr_lazy._metadata._metadata is None
+            assert np.all(syr_lazy.get_array(num_items - 1, 'label') == data_dict[num_items - 1]['label'])
+
+
+class TestMmapMethods(unittest.TestCase):
+    def test_random_item_read(self):
+        item_idxs = np.random.permutation(num_items)
+
+        for i in item_idxs:
+            for key, value in syr_mmap.get_item(i).items():
+                assert np.all(data_dict[i][key] == value)
+
+    def test_random_array_read(self):
+        item_idxs = np.random.permutation(num_items)
+
+        for i in item_idxs:
+            for key, value in data_dict[i].items():
+                assert np.all(syr_mmap.get_array(i, key) == value)
+
+    def test_stack_read(self):
+        for item_idxs in (np.arange(num_items), np.random.permutation(num_items)):
+            stack = syr_mmap.get_stack(item_idxs, 'label')
+            assert np.all(stack == np.stack([data_dict[i]['label'] for i in item_idxs]))
+
+    def test_access_hint(self):
+        for access_hint in ['sequential', 'random', None]:
+            syr_mmap.set_access_hint(access_hint)
+            assert np.all(syr_mmap.get_array(0, 'label') == data_dict[0]['label'])
+
+        with self.assertRaises(ValueError):
+            syr_mmap.set_access_hint('backward')
+
+
+class TestStringArrays(unittest.TestCase):
+    def test_string_read(self):
+        str_path = '/tmp/syrah_test_str.syr'
+        strings = [f'item {i} \u00e9' for i in range(10)]
+
+        with File(str_path, 'w') as syr_str:
+            for i, string in enumerate(strings):
+                syr_str.add_item({'name': np.array([string]), 'idx': np.array([i], dtype=np.int32),
+                                  'scalar_name': np.array(string)})
+
+        with File(str_path, 'r') as syr_str:
+            for i, string in enumerate(strings):
+                assert syr_str.get_array(i, 'name')[0] == string
+                assert syr_str.get_item(i)['name'][0] == string
+                assert syr_str.get_array(i, 'scalar_name')[0] == string
+
+        # strings cannot be stacked, in both read modes and even if they are contiguous
+        with File(str_path, 'w', columnar=True) as syr_str:
+            for string in strings:
+                syr_str.add_item({'name': np.array([string])})
+
+        for use_mmap in (False, True):
+            with File(str_path, 'r', use_mmap=use_mmap) as syr_str:
+                with self.assertRaises(TypeError):
+                    syr_str.get_stack(np.arange(len(strings)), 'name')
+
+    def test_truncated_string_read(self):
+        str_path = '/tmp/syrah_test_str_truncated.syr'
+
+        with File(str_path, 'w') as syr_str:
+            for i in range(10):
+                syr_str.add_item({'name': np.array([f'item {i}']), 'idx': np.array([i], dtype=np.int32)})
+
+        with File(str_path, 'r') as syr_str:
+            # fill the buffer pool with the bytes of another string first
+            assert syr_str.get_array(0, 'name')[0] == 'item 0'
+            offset, _, _ = syr_str._metadata.locate(9, 'name')
+            os.truncate(str_path, offset + 1)
+
+            with self.assertRaises(IOError):
+                syr_str.get_array(9, 'name')
+
+
+class TestArrayAlignment(unittest.TestCase):
+    def test_misaligned_item_read(self):
+        alignment_path = '/tmp/syrah_test_alignment.syr'
+
+        with File(alignment_path, 'w') as syr_alignment:
+            for i in range(10):
+                # the float64 arrays are stored at odd offsets
+                syr_alignment.add_item({'flags': np.arange(2 * i + 1, dtype=np.int8), 'values': np.arange(i / 2, 20)})
+
+        with File(alignment_path, 'r') as syr_alignment:
+            for i in range(10):
+                for syr_item in (syr_alignment.get_item(i), syr_alignment.get_item(i, array_names=['values', 'flags'])):
+                    assert syr_item['values'].flags.aligned
+                    assert np.all(syr_item['values'] == np.arange(i / 2, 20))
+                    assert np.all(syr_item['flags'] == np.arange(2 * i + 1, dtype=np.int8))
+
+
+class TestColumnarLayout(unittest.TestCase):
+    def test_random_item_read(self):
+        columnar_path = '/tmp/syrah_test_columnar.syr'
+
+        with File(columnar_path, 'w', columnar=True) as syr_columnar:
+            syr_columnar.add_items((data_dict[i] for i in range(num_items)), validate=False)
+
+        with File(columnar_path, 'r') as syr_columnar:
+            for i in np.random.permutation(num_items):
+                for key, value in syr_columnar.get_item(i).items():
+                    assert np.all(data_dict[i][key] == value)
+
+            stack = syr_columnar.get_stack(range(num_items), 'fixed_len_array')
+            assert np.all(stack == np.stack([data_dict[i]['fixed_len_array'] for i in range(num_items)]))
+
+
+class TestMetadataGrowth(unittest.TestCase):
+    def test_many_items(self):
+        growth_path = '/tmp/syrah_test_growth.syr'
+        num_growth_items = 2 * config.METADATA_INITIAL_CAPACITY + 1
+
+        with File(growth_path, 'w') as syr_growth:
+            for i in range(num_growth_items):
+                syr_growth.add_item({'index': np.array([i]), 'range': np.arange(i % 5)})
+
+        with File(growth_path, 'r') as syr_growth:
+            assert syr_growth.num_items() == num_growth_items
+            for i in range(num_growth_items):
+                item = syr_growth.get_item(i)
+                assert item['index'][0] == i
+                assert np.all(item['range'] == np.arange(i % 5))
+
+    def test_batch_add(self):
+        items_metadata = [{'index': {'offset': 8 * i, 'size': 8, 'dtype': 'int64'}}
+                          for i in range(2 * config.METADATA_INITIAL_CAPACITY + 1)]
+
+        single, batch = MetadataWriter(), MetadataWriter()
+        for item_metadata in items_metadata:
+            single.add_item(item_metadata)
+        batch.add_items(items_metadata[:3])
+        batch.add_items(items_metadata[3:])
+        assert single.tobytes() == batch.tobytes()
+
+        # an inconsistent item prevents the whole batch from being added
+        with self.assertRaises(ValueError):
+            batch.add_items(items_metadata[:2] + [{'index': {'offset': 0, 'size': 4, 'dtype': 'int32'}}])
+        assert len(batch) == len(items_metadata)
+
+
+class TestEmptyFile(unittest.TestCase):
+    def test_empty_read(self):
+        empty_path = '/tmp/syrah_test_empty.syr'
+
+        with File(empty_path, 'w'):
+            pass
+
+        for use_mmap in (False, True):
+            with File(empty_path, 'r', use_mmap=use_mmap) as syr_empty:
+                assert syr_empty.num_items() == 0
+                assert syr_empty.get_items([]) == []
+                assert syr_empty.get_batch([]) == dict()
+                with self.assertRaises(IndexError):
+                    syr_empty.get_item(0)
+
+
+class TestMetadataConsistency(unittest.TestCase):
+    def test_inconsistent_items(self):
+        with File('/tmp/syrah_test_consistency.syr', 'w') as syr_consistency:
+            syr_consistency.add_item({'label': np.array([0], dtype=np.int32), 'value': np.arange(3.)})
+
+            with self.assertRaisesRegex(ValueError, 'dtype value int64'):
+                syr_consistency.add_item({'label': np.array([1], dtype=np.int64), 'value': np.arange(3.)})
+            with self.assertRaises(KeyError):
+                syr_consistency.add_item({'label': np.array([1], dtype=np.int32)})
+
+
+class TestMetadataCache(unittest.TestCase):
+    def test_reopen(self):
+        cache_path = '/tmp/syrah_test_cache.syr'
+
+        with File(cache_path, 'w') as syr_cache:
+            syr_cache.add_item({'value': np.arange(3)})
+
+        with File(cache_path, 'r') as first, File(cache_path, 'r') as second:
+            assert first._metadata is second._metadata
+
+        File.clear_metadata_cache()
+        with File(cache_path, 'r') as first:
+            with File(cache_path, 'w') as syr_cache:
+                syr_cache.add_item({'value': np.arange(5)})
+                syr_cache.add_item({'value': np.arange(7)})
+
+            with File(cache_path, 'r') as second:
+                assert first._metadata is not second._metadata
+                assert second.num_items() == 2
+                assert np.all(second.get_array(1, 'value') == np.arange(7))
+
 
 class TestMultiMethods(unittest.TestCase):
     def test_sequential_item_read(self):
         item_idxs = range(num_items)
 
-        p = Pool(num_workers, initializer=syr.open, initargs=(syr_path, 'r'))
-        p.map(assert_item_read, item_idxs)
+        with Pool(num_workers, initializer=init_worker, initargs=(syr_path,)) as p:
+            p.map(assert_item_read, item_idxs)
 
     def test_sequential_array_read(self):
         item_idxs = range(num_items)
 
-        p = Pool(num_workers, initializer=syr.open, initargs=(syr_path, 'r'))
-        p.map(assert_array_read, item_idxs)
+        with Pool(num_workers, initializer=init_worker, initargs=(syr_path,)) as p:
+            p.map(assert_array_read, item_idxs)
 
     def test_random_item_read(self):
         item_idxs = np.random.permutation(num_items)
 
-        p = Pool(num_workers, initializer=syr.open, initargs=(syr_path, 'r'))
-        p.map(assert_item_read, item_idxs)
+        with Pool(num_workers, initializer=init_worker, initargs=(syr_path,)) as p:
+            p.map(assert_item_read, item_idxs)
 
     def test_random_array_read(self):
         item_idxs = np.random.permutation(num_items)
 
-        p = Pool(num_workers, initializer=syr.open, initargs=(syr_path, 'r'))
-        p.map(assert_array_read, item_idxs)
+        with Pool(num_workers, initializer=init_worker, initargs=(syr_path,)) as p:
+            p.map(assert_array_read, item_idxs)
 
 
 if __name__ == '__main__':